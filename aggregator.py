@@ -0,0 +1,153 @@
+"""
+Windowed summaries of each channel, e.g. 1 minute statistics of 1 second samples.
+
+Samples are folded into running accumulators as they arrive (Welford's
+method for the mean and variance), so memory doesn't grow with the window
+length. When a sample lands in a new window, the finished window is written as
+one row of the output SampleStore, timestamped with the window start.
+Windows are aligned to multiples of the window length, e.g. on the minute.
+
+Each channel emits the statistics chosen for it, by default just the mean:
+
+    Aggregator(window=60, stats={'temp' : ("mean", "min", "max"), 'pump' : ("max",)})
+
+The mean keeps the channel name, other statistics are suffixed, e.g. temp,
+temp_min, temp_max. Available statistics are mean, min, max, std (sample
+standard deviation) and count. Statistics beyond the output's max_channels
+are stored less efficiently, see output.on_full.
+"""
+
+from circuitpy_mcu.sample_store import SampleStore
+
+STATS = ("mean", "min", "max", "std", "count")
+
+
+class Accumulator():
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0 # sum of squared differences from the mean
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def std(self):
+        if self.count < 2:
+            return 0.0
+        return (self.m2 / (self.count - 1)) ** 0.5
+
+    def stat(self, name):
+        # min and max as floats, so a channel's type doesn't change with its inputs
+        if name == "mean":
+            return self.mean
+        if name == "std":
+            return self.std()
+        if name == "count":
+            return self.count
+        return float(getattr(self, name))
+
+
+class Aggregator():
+    def __init__(self, window=60, stats=None, default_stats=("mean",), capacity=360, max_channels=32):
+        self.window = window
+        self.channel_stats = {} # channel : statistics to emit
+        self.default_stats = default_stats
+        self.accumulators = {} # channel : Accumulator
+        self.window_start = None
+
+        # Completed windows, e.g. as Notecard_manager.timestamped_note via output.unsent
+        self.output = SampleStore(capacity=capacity, max_channels=max_channels)
+
+        # Counters
+        self.samples = 0
+        self.windows = 0
+
+        if stats:
+            for channel, channel_stats in stats.items():
+                self.set_stats(channel, channel_stats)
+
+    def set_stats(self, channel, stats):
+        for name in stats:
+            if name not in STATS:
+                raise ValueError(f"Unknown statistic {name} for {channel}")
+        self.channel_stats[channel] = stats
+
+    def add(self, ts, datadict):
+        """
+        Folds the numeric values in datadict into the current window.
+        Returns True if this completed the previous window.
+        """
+        start = ts - ts % self.window
+        completed = False
+        if self.window_start is not None and start != self.window_start:
+            # Also closes the window early if the clock was set back
+            completed = self.close()
+        self.window_start = start
+
+        for channel, value in datadict.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            acc = self.accumulators.get(channel)
+            if acc is None:
+                acc = Accumulator()
+                self.accumulators[channel] = acc
+            acc.add(value)
+        self.samples += 1
+        return completed
+
+    def _name(self, channel, stat):
+        if stat == "mean":
+            return channel
+        return f"{channel}_{stat}"
+
+    def close(self):
+        # Writes the current window to output and starts a new one.
+        # Returns False if there was nothing to write.
+        if self.window_start is None:
+            return False
+        output = self.output
+        written = False
+        for channel, acc in self.accumulators.items():
+            for stat in self.channel_stats.get(channel, self.default_stats):
+                name = self._name(channel, stat)
+                if acc.count:
+                    output[name] = acc.stat(stat)
+                    written = True
+                elif name in output:
+                    del output[name] # no samples this window
+            acc.reset()
+        if written:
+            output.commit(self.window_start)
+            self.windows += 1
+        self.window_start = None
+        return written
+
+    def summary(self):
+        # The current, incomplete window as a dict, e.g. for a display
+        result = {}
+        for channel, acc in self.accumulators.items():
+            if acc.count:
+                for stat in self.channel_stats.get(channel, self.default_stats):
+                    result[self._name(channel, stat)] = acc.stat(stat)
+        return result
+
+    def stats(self):
+        return {
+            "window"   : self.window,
+            "samples"  : self.samples,
+            "windows"  : self.windows,
+            "channels" : len(self.accumulators),
+            "unsent"   : len(self.output.unsent),
+            }
@@ -0,0 +1,214 @@
+"""
+Precompiled alarm schedules, e.g. for dosing.
+
+Rules are parsed once into a sorted table of seconds since midnight for each
+day of the week, and the next alarm is found by bisection. Rules can be:
+
+    "14:53"                      daily, also "14:53:30"
+    "Mon-Fri 08:00"              on certain days, e.g. "Sat,Sun", "Mon,Wed-Fri", "*"
+    "every 15m"                  an interval through the day, from midnight. s, m or h
+    "Mon-Fri every 30m 08:00-18:00"
+                                 an interval within a window, inclusive of the end
+    "*/15 6-18 * * 1-5"          cron style, minute hour day-of-month month day-of-week
+                                 (day-of-month and month must be *, day-of-week 0 or 7 is Sunday)
+
+Alarm times are local time, utc_offset_hours ahead of UTC (the RTC is UTC).
+The offset can be changed later without re-parsing.
+"""
+
+import time
+from array import array
+
+DAY = 24 * 60 * 60
+DAY_NAMES = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+# 1970-01-01 was a Thursday
+_EPOCH_WEEKDAY = 3
+
+
+def _bisect_right(table, x):
+    lo = 0
+    hi = len(table)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if x < table[mid]:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def parse_time(text):
+    # "HH:MM" or "HH:MM:SS" to seconds since midnight
+    parts = text.split(":")
+    if len(parts) not in (2, 3):
+        raise ValueError(f"invalid time {text}")
+    hours = int(parts[0])
+    mins = int(parts[1])
+    secs = int(parts[2]) if len(parts) == 3 else 0
+    if not (0 <= hours <= 24 and 0 <= mins < 60 and 0 <= secs < 60):
+        raise ValueError(f"invalid time {text}")
+    return hours * 3600 + mins * 60 + secs
+
+
+def parse_duration(text):
+    # e.g. "90s", "15m", "2h"
+    units = {"s" : 1, "m" : 60, "h" : 3600}
+    if not text or text[-1] not in units:
+        raise ValueError(f"invalid interval {text}, expected e.g. 15m")
+    seconds = int(text[:-1]) * units[text[-1]]
+    if seconds <= 0:
+        raise ValueError(f"invalid interval {text}")
+    return seconds
+
+
+def _day_index(text):
+    name = text.lower()[:3]
+    if name in DAY_NAMES:
+        return DAY_NAMES.index(name)
+    raise ValueError(f"invalid day {text}")
+
+
+def parse_days(text):
+    # "Mon-Fri", "Sat,Sun", "*" to a list of weekday numbers, Monday = 0
+    if text == "*":
+        return list(range(7))
+    days = []
+    for part in text.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            day = _day_index(first)
+            last = _day_index(last)
+            while True:
+                days.append(day)
+                if day == last:
+                    break
+                day = (day + 1) % 7
+        else:
+            days.append(_day_index(part))
+    return days
+
+
+def _parse_cron_field(text, low, high):
+    # "*", "*/n", "a", "a-b", "a-b/n", and comma separated lists of those
+    values = []
+    for part in text.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/")
+            step = int(step)
+            if step <= 0:
+                raise ValueError(f"invalid step in {text}")
+        if part == "*":
+            first, last = low, high
+        elif "-" in part:
+            first, last = part.split("-")
+            first, last = int(first), int(last)
+        else:
+            first = last = int(part)
+        if first < low or last > high or first > last:
+            raise ValueError(f"{text} out of range {low}-{high}")
+        values.extend(range(first, last + 1, step))
+    return values
+
+
+def _parse_cron(fields):
+    minutes = _parse_cron_field(fields[0], 0, 59)
+    hours = _parse_cron_field(fields[1], 0, 23)
+    if fields[2] != "*" or fields[3] != "*":
+        raise ValueError("only * is supported for day-of-month and month")
+    # cron counts from Sunday = 0 (or 7), convert to Monday = 0
+    days = [(d + 6) % 7 for d in _parse_cron_field(fields[4], 0, 7)]
+    seconds = [h * 3600 + m * 60 for h in hours for m in minutes]
+    return days, seconds
+
+
+def parse_rule(rule):
+    """
+    Returns (days, seconds), the weekdays (Monday = 0) a rule applies to,
+    and its alarm times in seconds since midnight.
+    """
+    tokens = rule.split()
+    if len(tokens) == 5:
+        return _parse_cron(tokens)
+
+    days = list(range(7))
+    if tokens and tokens[0] != "every" and not tokens[0][0].isdigit():
+        days = parse_days(tokens.pop(0))
+    if not tokens:
+        raise ValueError(f"invalid alarm {rule}")
+
+    if tokens[0] == "every":
+        if len(tokens) not in (2, 3):
+            raise ValueError(f"invalid alarm {rule}")
+        interval = parse_duration(tokens[1])
+        start, end = 0, DAY - 1
+        if len(tokens) == 3:
+            start, end = [parse_time(t) for t in tokens[2].split("-")]
+            end = min(end, DAY - 1)
+        return days, list(range(start, end + 1, interval))
+
+    if len(tokens) != 1:
+        raise ValueError(f"invalid alarm {rule}")
+    return days, [parse_time(tokens[0]) % DAY]
+
+
+class AlarmSchedule():
+    def __init__(self, rules, utc_offset_hours=0):
+        if isinstance(rules, str):
+            rules = [rules]
+        self.source = tuple(rules)
+        self.utc_offset_hours = utc_offset_hours
+
+        days = [[] for _ in range(7)]
+        for rule in rules:
+            rule_days, seconds = parse_rule(rule)
+            for day in rule_days:
+                days[day].extend(seconds)
+
+        # One sorted array per weekday. Days with identical alarms share a table.
+        self.tables = []
+        compiled = {} # tuple of seconds : table
+        for seconds in days:
+            key = tuple(sorted(set(seconds)))
+            table = compiled.get(key)
+            if table is None:
+                table = array("l", key)
+                compiled[key] = table
+            self.tables.append(table)
+
+    def __len__(self):
+        return sum(len(table) for table in self.tables)
+
+    def seconds_until_next(self, now=None):
+        """
+        Returns the number of seconds until the next alarm, strictly after now
+        (epoch seconds, default time.time()). None if there are no alarms.
+        """
+        if now is None:
+            now = time.time()
+        local = int(now) + int(self.utc_offset_hours * 3600)
+        days, second = divmod(local, DAY)
+        weekday = (days + _EPOCH_WEEKDAY) % 7
+
+        # Today, then up to a week ahead, including today's weekday next week
+        for ahead in range(8):
+            table = self.tables[(weekday + ahead) % 7]
+            if not table:
+                continue
+            if ahead == 0:
+                i = _bisect_right(table, second)
+                if i < len(table):
+                    return table[i] - second
+            else:
+                return ahead * DAY + table[0] - second
+        return None
+
+    def next_alarm(self, now=None):
+        # Epoch seconds of the next alarm, or None
+        if now is None:
+            now = time.time()
+        seconds = self.seconds_until_next(now)
+        if seconds is None:
+            return None
+        return int(now) + seconds
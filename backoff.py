@@ -0,0 +1,136 @@
+"""
+Exponential backoff and a circuit breaker, for Notecard connection attempts.
+
+Backoff spaces out repeated attempts (e.g. hub.sync while not connected),
+doubling the delay after each failure up to max_delay, with random jitter so
+that a fleet of devices doesn't retry in step.
+
+CircuitBreaker guards an expensive recovery action (e.g. reconfigure and
+restart the Notecard). After `threshold` consecutive failures it opens, and
+the action is refused until `cooldown` seconds have passed. It then allows one
+trial (half open), and a further failure reopens it.
+
+Both keep their state in microcontroller.nvm (see persist.py) using RTC
+epoch seconds, so a reboot doesn't reset them.
+"""
+
+import time
+import random
+
+from circuitpy_mcu.persist import nvm_read, nvm_write
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+
+def _load(offset, now, limit):
+    # Reads a persisted deadline, discarding it if it's implausibly far away,
+    # e.g. the RTC was reset by a power cycle
+    value = nvm_read(offset) or 0
+    if value - now > limit:
+        return 0
+    return value
+
+
+class Backoff():
+    def __init__(self, base=60, factor=2, max_delay=3600, jitter=0.5, nvm_failures=None, nvm_retry_at=None):
+        self.base = base
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter # fraction of the delay that is randomised
+        self._nvm_failures = nvm_failures
+        self._nvm_retry_at = nvm_retry_at
+
+        self.failures = 0 # consecutive
+        self.retry_at = 0 # epoch seconds
+        if nvm_failures is not None:
+            self.failures = nvm_read(nvm_failures) or 0
+        if nvm_retry_at is not None:
+            self.retry_at = _load(nvm_retry_at, time.time(), max_delay)
+
+    def ready(self, now=None):
+        if now is None:
+            now = time.time()
+        return now >= self.retry_at
+
+    def remaining(self, now=None):
+        if now is None:
+            now = time.time()
+        return max(0, self.retry_at - now)
+
+    def delay(self):
+        # Delay after the current number of failures, before jitter
+        if self.failures == 0:
+            return 0
+        return min(self.max_delay, self.base * self.factor ** (self.failures - 1))
+
+    def failure(self, now=None):
+        if now is None:
+            now = time.time()
+        self.failures += 1
+        delay = self.delay() * (1 - self.jitter * random.random())
+        self.retry_at = int(now + delay)
+        self._store()
+        return delay
+
+    def success(self):
+        if self.failures or self.retry_at:
+            self.failures = 0
+            self.retry_at = 0
+            self._store()
+
+    def _store(self):
+        if self._nvm_failures is not None:
+            nvm_write(self._nvm_failures, self.failures)
+        if self._nvm_retry_at is not None:
+            nvm_write(self._nvm_retry_at, self.retry_at)
+
+
+class CircuitBreaker():
+    def __init__(self, threshold=3, cooldown=6*3600, nvm_failures=None, nvm_open_until=None):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._nvm_failures = nvm_failures
+        self._nvm_open_until = nvm_open_until
+
+        self.failures = 0 # consecutive
+        self.open_until = 0 # epoch seconds
+        self.trips = 0 # times opened since boot
+        if nvm_failures is not None:
+            self.failures = nvm_read(nvm_failures) or 0
+        if nvm_open_until is not None:
+            self.open_until = _load(nvm_open_until, time.time(), cooldown)
+
+    def state(self, now=None):
+        if now is None:
+            now = time.time()
+        if self.failures < self.threshold:
+            return BREAKER_CLOSED
+        if now < self.open_until:
+            return BREAKER_OPEN
+        return BREAKER_HALF_OPEN
+
+    def allow(self, now=None):
+        return self.state(now) != BREAKER_OPEN
+
+    def failure(self, now=None):
+        if now is None:
+            now = time.time()
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.open_until = int(now + self.cooldown)
+            self.trips += 1
+        self._store()
+
+    def success(self):
+        if self.failures or self.open_until:
+            self.failures = 0
+            self.open_until = 0
+            self._store()
+
+    def _store(self):
+        if self._nvm_failures is not None:
+            nvm_write(self._nvm_failures, self.failures)
+        if self._nvm_open_until is not None:
+            nvm_write(self._nvm_open_until, self.open_until)
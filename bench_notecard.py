@@ -0,0 +1,541 @@
+"""
+Host-side benchmarks, run with CPython using the Notecard simulator in notecard_sim.py
+
+    python bench_notecard.py loop --hours 2 --latency 0.02 --failure-rate 0.01
+
+loop:   runs the simpletest_notecard.py main loop on a virtual clock and reports
+        Notecard transactions per service cycle, loop latency and allocations.
+        Loop latency is host CPU time plus the simulated Notecard latency and any
+        time.sleep() in that iteration, so it's only indicative of the device.
+
+journal: simulates a Notecard outage with the note journal enabled, samples every
+        minute and sends every 15 minutes, then reconnects and replays. Reports
+        flash bytes written per sample and write/replay throughput.
+
+logging: runs the loop at INFO and measures allocations inside logger calls,
+        with level-gated formatting (lazy_logger.py) and with --eager, which formats
+        every message before the level check, as adafruit_logging and f-strings do.
+
+telemetry: streams mcu.data as binary frames to a simulated usb_cdc.data port,
+        reports frames per second (host), allocations per frame, and checks the
+        frames decode with no sequence gaps.
+
+aggregate: captures every second and compares the data.qo body sizes for
+        sending every sample against one summary per --window (aggregator.py),
+        and checks the streamed statistics against a direct calculation.
+
+deadband: compresses each channel with compression.py and reports the points
+        kept, body sizes and the worst reconstruction error. Uses synthetic
+        tank level, pump state and temperature channels, or --csv with a
+        header row of ts then one column per channel.
+"""
+
+import argparse
+import contextlib
+import csv
+import json
+import math
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import notecard_sim
+
+MINUTES = 60
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def quiet():
+    # The Mcu log handler prints every record
+    return contextlib.redirect_stdout(open(os.devnull, "w"))
+
+
+def setup(args):
+    clock = notecard_sim.VirtualClock()
+    card = notecard_sim.FakeNotecard(latency=args.latency, seed=args.seed)
+    sim = notecard_sim.install_host_shims(card=card, clock=clock)
+    random.seed(args.seed)
+    return sim
+
+
+def simpletest_app(loglevel):
+    # Sets up simpletest_notecard.py, returns (mcu, ncm)
+    import adafruit_logging as logging
+    from circuitpy_mcu.mcu import Mcu
+    from circuitpy_mcu.notecard_manager import Notecard_manager
+
+    with quiet():
+        mcu = Mcu(loglevel=loglevel, i2c_freq=100000)
+        ncm = Notecard_manager(loghandler=mcu.loghandler, i2c=mcu.i2c, loglevel=loglevel,
+                               sample_store=mcu.data)
+
+    env = {
+        'pump1-speed' : "0.54",
+        'pump2-speed' : "0.55",
+        }
+    with quiet():
+        ncm.set_default_envs(env)
+    ncm.subscribe_env('pump1-speed', lambda key, val: float(val))
+    ncm.subscribe_env('pump2-speed', lambda key, val: float(val))
+    ncm.subscribe_note('data.qi', lambda body: None)
+
+    # --- simpletest_notecard.py tasks ---
+    def capture():
+        mcu.led.value = not mcu.led.value
+        timestamp = mcu.get_timestamp()
+        mcu.display_text(timestamp)
+        mcu.data['temp'] = round(random.uniform(15, 30), 4)
+        mcu.data['humidity'] = round(random.uniform(45, 70), 4)
+
+    def service_notecard():
+        mcu.log.debug("servicing notecard now %s", mcu.get_timestamp())
+        ncm.request_status()
+        ncm.add_to_timestamped_note(mcu.data)
+        ncm.send_if_due()
+        ncm.dispatch(env)
+
+    mcu.scheduler.every(1, capture, priority=1)
+    mcu.scheduler.every(1 * MINUTES, service_notecard)
+    # ---
+    return mcu, ncm
+
+
+def bench_loop(args):
+    sim = setup(args)
+    clock = sim.clock
+    card = sim.card
+
+    import adafruit_logging as logging
+    mcu, ncm = simpletest_app(logging.INFO)
+
+    # Startup blocks until the card has the time, so only degrade the link afterwards
+    card.connected = not args.disconnected
+    card.failure_rate = args.failure_rate
+
+    latencies = []
+    busy_latencies = []
+    transactions = []
+    alloc_peaks = []
+
+    iterations = int(args.hours * 3600 / args.step)
+    if args.alloc:
+        tracemalloc.start()
+
+    with quiet():
+        for _ in range(iterations):
+            clock.advance(args.step)
+
+            tx0 = card.transaction_count
+            busy0 = card.busy_time
+            slept0 = clock.slept
+            if args.alloc:
+                tracemalloc.reset_peak()
+                alloc0 = tracemalloc.get_traced_memory()[0]
+            t0 = time.perf_counter()
+
+            # --- simpletest_notecard.py main loop body ---
+            mcu.service()
+            ncm.service()
+            # ---
+
+            elapsed = time.perf_counter() - t0
+            elapsed += (card.busy_time - busy0) + (clock.slept - slept0)
+            n = card.transaction_count - tx0
+            latencies.append(elapsed)
+            transactions.append(n)
+            if n:
+                busy_latencies.append(elapsed)
+            if args.alloc:
+                alloc_peaks.append(tracemalloc.get_traced_memory()[1] - alloc0)
+
+    if args.alloc:
+        tracemalloc.stop()
+
+    busy_cycles = [n for n in transactions if n]
+    print(f"simulated {args.hours}h, {iterations} loop iterations of {args.step * 1000:.0f}ms")
+    print(f"card latency {args.latency * 1000:.1f}ms, failure rate {args.failure_rate}, "
+          f"connected={not args.disconnected}")
+    print(f"notecard transactions: {card.transaction_count} total, "
+          f"{len(busy_cycles)} cycles with transactions, "
+          f"mean {sum(busy_cycles) / max(1, len(busy_cycles)):.2f}, max {max(transactions)} per cycle")
+    print(f"loop latency ms, all cycles:  p50 {percentile(latencies, 50) * 1000:.3f}  "
+          f"p95 {percentile(latencies, 95) * 1000:.3f}  max {max(latencies) * 1000:.3f}")
+    print(f"loop latency ms, busy cycles: p50 {percentile(busy_latencies, 50) * 1000:.3f}  "
+          f"p95 {percentile(busy_latencies, 95) * 1000:.3f}  max {max(busy_latencies, default=0) * 1000:.3f}")
+    if args.alloc:
+        print(f"allocation peak bytes per cycle: mean {sum(alloc_peaks) / len(alloc_peaks):.0f}  "
+              f"p95 {percentile(alloc_peaks, 95)}  max {max(alloc_peaks)}")
+    print("tasks:", mcu.scheduler.stats())
+    print("requests:", dict(sorted(card.counts.items())))
+
+
+def bench_journal(args):
+    sim = setup(args)
+    clock = sim.clock
+    card = sim.card
+
+    import adafruit_logging as logging
+    from circuitpy_mcu.mcu import Mcu
+    from circuitpy_mcu.notecard_manager import Notecard_manager
+
+    tmp = tempfile.mkdtemp()
+    with quiet():
+        mcu = Mcu(loglevel=logging.ERROR, i2c_freq=100000)
+        ncm = Notecard_manager(loghandler=mcu.loghandler, i2c=mcu.i2c, loglevel=logging.ERROR, journal_path=os.path.join(tmp, "journal"),
+                               journal_max_bytes=args.max_bytes)
+    journal = ncm.journal
+    data = {'temp' : 0.0, 'humidity' : 0.0}
+
+    # Every note.add fails during the outage
+    card.inject_failure("note.add", count=10**9)
+    samples = 0
+    write_time = 0
+    minutes = int(args.hours * 60)
+    with quiet():
+        for minute in range(1, minutes + 1):
+            clock.advance(MINUTES)
+            data['temp'] = round(random.uniform(15, 30), 4)
+            data['humidity'] = round(random.uniform(45, 70), 4)
+            ncm.add_to_timestamped_note(data)
+            samples += 1
+            if minute % 15 == 0:
+                t0 = time.perf_counter()
+                ncm.send_timestamped_note(sync=True, compact=args.compact)
+                write_time += time.perf_counter() - t0
+    card._failures = []
+
+    written = journal.bytes_written
+    added0 = card.counts.get("note.add", 0)
+    replay_time = 0
+    replayed = 0
+    with quiet():
+        ncm.connected = True
+        while journal.pending_replay:
+            clock.advance(args.step)
+            busy0 = card.busy_time
+            t0 = time.perf_counter()
+            ncm.service()
+            replay_time += time.perf_counter() - t0 + card.busy_time - busy0
+        replayed = card.counts.get("note.add", 0) - added0
+
+    print(f"simulated {args.hours}h outage, {samples} samples, compact={args.compact}")
+    print(f"journal: {journal.records_written} records, {written} bytes written, "
+          f"{written / max(1, samples):.1f} bytes per sample")
+    print(f"journal stats: {journal.stats()}")
+    print(f"write throughput: {written / max(write_time, 1e-9) / 1024:.0f} KiB/s (host, includes failed send)")
+    print(f"replay: {replayed} notes in {replay_time * 1000:.1f}ms "
+          f"({replay_time / max(1, replayed) * 1000:.2f}ms per note, incl. {args.latency * 1000:.1f}ms card latency)")
+    print(f"notes queued on the card: {len(card.notefiles.get('data.qo', []))}")
+
+
+def bench_logging(args):
+    sim = setup(args)
+
+    import adafruit_logging as logging
+    from circuitpy_mcu import lazy_logger
+
+    # Measure allocation inside each outermost logger call
+    stats = {"calls" : 0, "output" : 0, "bytes" : 0}
+    depth = [0]
+
+    def measured(method, level):
+        def wrapper(self, msg, *fmt_args):
+            if depth[0]:
+                return method(self, msg, *fmt_args)
+            depth[0] += 1
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            try:
+                if args.eager and fmt_args:
+                    msg = msg % fmt_args
+                    fmt_args = ()
+                if args.eager and level is not None and not isinstance(msg, str):
+                    msg = str(msg)
+                return method(self, msg, *fmt_args)
+            finally:
+                stats["calls"] += 1
+                if level is None or level >= self.level:
+                    stats["output"] += 1
+                stats["bytes"] += tracemalloc.get_traced_memory()[1] - base
+                depth[0] -= 1
+        return wrapper
+
+    cls = lazy_logger.LazyLogger
+    for name, level in (("debug", logging.DEBUG), ("info", logging.INFO), ("warning", logging.WARNING),
+                        ("error", logging.ERROR), ("critical", logging.CRITICAL)):
+        setattr(cls, name, measured(getattr(cls, name), level))
+
+    mcu, ncm = simpletest_app(logging.INFO)
+    iterations = int(args.hours * 3600 / args.step)
+    tracemalloc.start()
+    stats.update(calls=0, output=0, bytes=0)
+    with quiet():
+        for _ in range(iterations):
+            sim.clock.advance(args.step)
+            mcu.service()
+            ncm.service()
+    tracemalloc.stop()
+
+    mode = "eager (f-string / adafruit_logging)" if args.eager else "level-gated"
+    print(f"simulated {args.hours}h at INFO, {mode} formatting")
+    print(f"logger calls {stats['calls']}, output {stats['output']}, "
+          f"allocated {stats['bytes']} bytes ({stats['bytes'] / max(1, stats['calls']):.0f} per call, "
+          f"{stats['bytes'] / args.hours / 1024:.1f} KiB per hour)")
+
+
+def bench_telemetry(args):
+    sim = setup(args)
+
+    import adafruit_logging as logging
+    from circuitpy_mcu.mcu import Mcu
+    from circuitpy_mcu.telemetry import FrameParser
+
+    with quiet():
+        mcu = Mcu(loglevel=logging.ERROR)
+        mcu.enable_telemetry()
+    for i in range(args.channels):
+        mcu.data[f"ch{i}"] = 0.0
+
+    allocs = []
+    t0 = time.perf_counter()
+    for n in range(args.samples):
+        for i in range(args.channels):
+            mcu.data[f"ch{i}"] = n + i / 10
+        if args.alloc:
+            tracemalloc.start()
+            mcu.stream_data()
+            allocs.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        else:
+            mcu.stream_data()
+    elapsed = time.perf_counter() - t0
+
+    stream = mcu.telemetry
+    frames = FrameParser()
+    samples = frames.feed(bytes(sim.data_port.tx))
+    # float32 on the wire
+    ok = all(abs(s[2][f"ch{i}"] - (n + i / 10)) <= 1e-6 * (n + 1)
+             for n, s in enumerate(samples) for i in range(args.channels))
+
+    print(f"{args.samples} samples of {args.channels} channels, {stream.frames} frames, "
+          f"{stream.bytes} bytes ({stream.bytes / stream.frames:.1f} per frame)")
+    print(f"host: {stream.frames / elapsed:.0f} frames/s")
+    if args.alloc:
+        print(f"allocation peak bytes per frame, incl. the simulated port's buffer: mean {sum(allocs) / len(allocs):.0f}  "
+              f"p95 {percentile(allocs, 95)}  max {max(allocs)}")
+    print(f"decoded {len(samples)} samples, {frames.lost} lost, {frames.resyncs} resyncs, values ok={ok}")
+
+
+def bench_aggregate(args):
+    setup(args)
+
+    from circuitpy_mcu.aggregator import Aggregator
+    from circuitpy_mcu.sample_store import SampleStore
+
+    stats = tuple(args.stats.split(","))
+    channels = [f"ch{i}" for i in range(args.channels)]
+    raw = SampleStore(capacity=int(args.hours * 3600) + 1)
+    agg = Aggregator(window=args.window, default_stats=stats, capacity=int(args.hours * 3600 / args.window) + 1)
+
+    t0 = 1700000000 - 1700000000 % args.window # on a window boundary
+    window_values = []
+    for n in range(int(args.hours * 3600)):
+        ts = t0 + n
+        for i, ch in enumerate(channels):
+            raw[ch] = round(20 + i + random.gauss(0, 0.5), 4)
+        raw.unsent.append(ts, raw)
+        agg.add(ts, raw)
+        if n < args.window:
+            window_values.append(raw["ch0"])
+    agg.close()
+
+    def size(window):
+        body = window.columnar() if args.compact else window.as_dict()
+        return len(json.dumps(body))
+
+    raw_bytes = size(raw.unsent)
+    agg_bytes = size(agg.output.unsent)
+    print(f"{args.hours}h of 1s samples, {args.channels} channels, {args.window}s windows of {','.join(stats)}, compact={args.compact}")
+    print(f"every sample: {len(raw.unsent)} rows, {raw_bytes} bytes")
+    print(f"aggregated:   {len(agg.output.unsent)} rows, {agg_bytes} bytes ({raw_bytes / agg_bytes:.1f}x smaller)")
+
+    # First window of ch0, recomputed directly
+    first = agg.output.sample(0)[1]
+    mean = sum(window_values) / len(window_values)
+    std = (sum((v - mean) ** 2 for v in window_values) / (len(window_values) - 1)) ** 0.5
+    expected = {"ch0" : mean, "ch0_min" : min(window_values), "ch0_max" : max(window_values),
+                "ch0_std" : std, "ch0_count" : len(window_values)}
+    ok = all(abs(first[key] - expected[key]) <= 1e-5 * max(1, abs(expected[key]))
+             for key in expected if key in first)
+    print(f"first window of ch0: {first.get('ch0')=}, statistics ok={ok}")
+
+
+def synthetic_channels(hours, interval):
+    # Returns (times, {channel : values}), slowly changing like a pumped tank
+    times = []
+    channels = {"tank" : [], "pump" : [], "temp" : []}
+    level = 50.0
+    pump = 0
+    next_switch = 0
+    t0 = 1700000000
+    for n in range(int(hours * 3600 / interval)):
+        ts = t0 + n * interval
+        if ts >= next_switch:
+            pump = 1 - pump
+            next_switch = ts + random.uniform(20, 60) * MINUTES
+        level = min(100.0, max(0.0, level + (0.02 if pump else -0.005) * interval))
+        times.append(ts)
+        channels["tank"].append(round(level + random.gauss(0, 0.05), 3))
+        channels["pump"].append(pump)
+        channels["temp"].append(round(20 + 5 * math.sin(2 * math.pi * (ts % 86400) / 86400)
+                                      + random.gauss(0, 0.05), 3))
+    return times, channels
+
+
+def read_csv_channels(path):
+    times = []
+    channels = {}
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        names = next(reader)[1:]
+        for name in names:
+            channels[name] = []
+        for row in reader:
+            times.append(int(float(row[0])))
+            for name, val in zip(names, row[1:]):
+                channels[name].append(float(val) if val != "" else None)
+    return times, channels
+
+
+def bench_deadband(args):
+    setup(args)
+
+    from circuitpy_mcu.compression import Compressor, Deadband, SwingingDoor, reconstruct
+
+    if args.csv:
+        times, channels = read_csv_channels(args.csv)
+    else:
+        times, channels = synthetic_channels(args.hours, args.interval)
+
+    method = {"deadband" : Deadband, "swinging_door" : SwingingDoor}[args.method]
+    filters = {name : method(args.tolerance, max_interval=args.max_interval) for name in channels}
+    compressor = Compressor(filters=filters, capacity=len(times) + 1)
+    for n, ts in enumerate(times):
+        sample = {name : values[n] for name, values in channels.items() if values[n] is not None}
+        compressor.add(ts, sample)
+    compressor.flush()
+
+    # Reconstruct from what would be sent, i.e. the float32 values in the store
+    kept = {name : [] for name in channels}
+    for ts, row in compressor.output.unsent.entries():
+        for name, val in row.items():
+            kept[name].append((ts, val))
+
+    print(f"{len(times)} samples of {len(channels)} channels, {args.method} tolerance {args.tolerance}, "
+          f"max interval {args.max_interval}s")
+    worst = 0
+    for name, values in channels.items():
+        rebuilt = reconstruct(kept[name], times, method.linear)
+        errors = [abs(a - b) for a, b in zip(values, rebuilt) if a is not None and b is not None]
+        error = max(errors) if errors else 0
+        worst = max(worst, error / args.tolerance if args.tolerance else error)
+        count = sum(1 for val in values if val is not None)
+        print(f"  {name:12} {count} samples, kept {len(kept[name])} ({count / max(1, len(kept[name])):.1f}x), "
+              f"max error {error:.4f}")
+
+    raw = uncompressed_bytes(times, channels, args.compact)
+    body = compressor.output.unsent.columnar() if args.compact else compressor.output.unsent.as_dict()
+    print(f"points: {compressor.stats()}")
+    print(f"body bytes: every sample {raw}, compressed {len(json.dumps(body))} "
+          f"({raw / len(json.dumps(body)):.1f}x smaller), compact={args.compact}")
+    # float32 storage adds a little error on top of the tolerance
+    print(f"within tolerance: {worst <= 1 + 1e-4}")
+
+
+def uncompressed_bytes(times, channels, compact):
+    from circuitpy_mcu.sample_store import SampleStore
+    store = SampleStore(capacity=len(times) + 1)
+    for n, ts in enumerate(times):
+        for name, values in channels.items():
+            if values[n] is not None:
+                store[name] = values[n]
+        store.unsent.append(ts, store)
+    body = store.unsent.columnar() if compact else store.unsent.as_dict()
+    return len(json.dumps(body))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    loop = sub.add_parser("loop", help="simpletest_notecard.py main loop")
+    loop.add_argument("--hours", type=float, default=1.0)
+    loop.add_argument("--step", type=float, default=0.01, help="simulated seconds per loop iteration")
+    loop.add_argument("--latency", type=float, default=0.01, help="simulated seconds per Notecard transaction")
+    loop.add_argument("--failure-rate", type=float, default=0.0)
+    loop.add_argument("--disconnected", action="store_true", help="lose the connection after startup")
+    loop.add_argument("--alloc", action="store_true", help="trace allocations (slow)")
+    loop.add_argument("--seed", type=int, default=0)
+    loop.set_defaults(func=bench_loop)
+
+    journal = sub.add_parser("journal", help="spill to flash during a Notecard outage, then replay")
+    journal.add_argument("--hours", type=float, default=6.0, help="length of the outage")
+    journal.add_argument("--step", type=float, default=0.01, help="simulated seconds per loop iteration during replay")
+    journal.add_argument("--latency", type=float, default=0.01, help="simulated seconds per Notecard transaction")
+    journal.add_argument("--max-bytes", type=int, default=32768, help="journal size limit")
+    journal.add_argument("--compact", action="store_true", help="spill in columnar form")
+    journal.add_argument("--seed", type=int, default=0)
+    journal.set_defaults(func=bench_journal)
+
+    log = sub.add_parser("logging", help="allocations in logger calls on the main loop")
+    log.add_argument("--hours", type=float, default=1.0)
+    log.add_argument("--step", type=float, default=0.1, help="simulated seconds per loop iteration")
+    log.add_argument("--eager", action="store_true", help="format before the level check, for comparison")
+    log.add_argument("--latency", type=float, default=0.0)
+    log.add_argument("--seed", type=int, default=0)
+    log.set_defaults(func=bench_logging)
+
+    telemetry = sub.add_parser("telemetry", help="binary telemetry frames on usb_cdc.data")
+    telemetry.add_argument("--samples", type=int, default=10000)
+    telemetry.add_argument("--channels", type=int, default=4)
+    telemetry.add_argument("--alloc", action="store_true", help="trace allocations (slow)")
+    telemetry.add_argument("--latency", type=float, default=0.0)
+    telemetry.add_argument("--seed", type=int, default=0)
+    telemetry.set_defaults(func=bench_telemetry)
+
+    aggregate = sub.add_parser("aggregate", help="windowed summaries versus every sample")
+    aggregate.add_argument("--hours", type=float, default=1.0)
+    aggregate.add_argument("--window", type=int, default=60, help="seconds per summary")
+    aggregate.add_argument("--stats", default="mean,min,max", help="statistics per channel, from mean,min,max,std,count")
+    aggregate.add_argument("--channels", type=int, default=4)
+    aggregate.add_argument("--compact", action="store_true", help="compare columnar bodies")
+    aggregate.add_argument("--latency", type=float, default=0.0)
+    aggregate.add_argument("--seed", type=int, default=0)
+    aggregate.set_defaults(func=bench_aggregate)
+
+    deadband = sub.add_parser("deadband", help="per-channel deadband / swinging door compression")
+    deadband.add_argument("--csv", help="recorded data, ts then one column per channel")
+    deadband.add_argument("--hours", type=float, default=24.0, help="synthetic data length")
+    deadband.add_argument("--interval", type=int, default=10, help="synthetic seconds per sample")
+    deadband.add_argument("--method", choices=("deadband", "swinging_door"), default="swinging_door")
+    deadband.add_argument("--tolerance", type=float, default=0.5)
+    deadband.add_argument("--max-interval", type=int, default=3600, help="heartbeat seconds")
+    deadband.add_argument("--compact", action="store_true", help="compare columnar bodies")
+    deadband.add_argument("--latency", type=float, default=0.0)
+    deadband.add_argument("--seed", type=int, default=0)
+    deadband.set_defaults(func=bench_deadband)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
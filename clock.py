@@ -0,0 +1,51 @@
+"""
+Shared, per-second cache of the current time.
+
+Formatting a "YYYY-MM-DD HH:MM:SS" timestamp from rtc.datetime allocates a
+struct_time and a string each time. The main loop asks for it on every log
+record and display refresh, but it only changes once a second. Clock keeps the
+formatted string for each UTC offset in use, and rebuilds it only when
+time.time() (which reads the RTC) moves on.
+
+Mcu and Notecard_manager share the module-level instance, `clock`.
+"""
+
+import time
+
+
+class Clock():
+    def __init__(self):
+        self._cache = {} # utc_offset_hours : [epoch second, formatted string]
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+
+    def epoch(self):
+        # Seconds since 1970, from the RTC
+        return time.time()
+
+    def timestamp(self, utc_offset_hours=0):
+        # "YYYY-MM-DD HH:MM:SS", utc_offset_hours ahead of the RTC (UTC)
+        now = time.time()
+        entry = self._cache.get(utc_offset_hours)
+        if entry is not None and entry[0] == now:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        t = time.localtime(now + int(utc_offset_hours * 3600))
+        text = f'{t.tm_year}-{t.tm_mon:02}-{t.tm_mday:02} {t.tm_hour:02}:{t.tm_min:02}:{t.tm_sec:02}'
+        if entry is None:
+            self._cache[utc_offset_hours] = [now, text]
+        else:
+            entry[0] = now
+            entry[1] = text
+        return text
+
+    def invalidate(self):
+        # Call after setting the RTC
+        self._cache = {}
+
+
+clock = Clock()
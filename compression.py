@@ -0,0 +1,220 @@
+"""
+Per-channel compression of slowly changing datapoints, e.g. tank levels and pump states.
+
+Each filter sees every sample of its channel, and keeps only the points needed
+to reconstruct the signal within its tolerance:
+
+    Deadband(tolerance)     - keeps a point when the value moves more than
+                              tolerance from the last kept point. Reconstruct
+                              by holding the last kept value. tolerance=0 keeps
+                              only changes, e.g. for pump states.
+    SwingingDoor(tolerance) - keeps the end points of straight line segments
+                              that pass within tolerance of every sample
+                              between them.
+                              Reconstruct by linear interpolation. A point is
+                              only known to be an end point once the next
+                              sample arrives, so points are kept one sample late.
+
+Both also keep a point at least every max_interval seconds, as a heartbeat
+that shows the channel is still alive.
+
+Compressor applies a filter per channel, and writes the kept points to an
+output SampleStore. Channels without a point at a timestamp are left missing.
+Channels without a filter are kept every sample.
+
+reconstruct() has no CircuitPython dependencies, so can be used host-side.
+"""
+
+from circuitpy_mcu.sample_store import SampleStore
+
+
+class Deadband():
+    linear = False
+
+    def __init__(self, tolerance, max_interval=3600):
+        self.tolerance = tolerance
+        self.max_interval = max_interval
+        self.last_ts = None # last kept point
+        self.last_value = None
+
+    def offer(self, ts, value):
+        # Returns (ts, value) to keep, or None
+        if (self.last_ts is None
+                or abs(value - self.last_value) > self.tolerance
+                or ts - self.last_ts >= self.max_interval):
+            self.last_ts = ts
+            self.last_value = value
+            return ts, value
+        return None
+
+    def flush(self):
+        # Nothing is held back
+        return None
+
+
+class SwingingDoor():
+    linear = True
+
+    def __init__(self, tolerance, max_interval=3600):
+        self.tolerance = tolerance
+        self.max_interval = max_interval
+        self.last_ts = None # last kept point, where the doors are hinged
+        self.last_value = None
+        self.prev_ts = None # the previous sample, kept if the doors open
+        self.prev_value = None
+        self.upper = None # the slopes of the doors
+        self.lower = None
+
+    def _hinge(self, ts, value):
+        self.last_ts = ts
+        self.last_value = value
+        self.upper = None
+        self.lower = None
+
+    def _swing(self, ts, value):
+        # Returns False if a segment from the hinge to ts, value would pass
+        # outside tolerance of the samples between. Otherwise narrows the doors
+        # to include it.
+        dt = ts - self.last_ts
+        if self.upper is not None:
+            slope = (value - self.last_value) / dt
+            if slope > self.upper or slope < self.lower:
+                return False
+        upper = (value + self.tolerance - self.last_value) / dt
+        lower = (value - self.tolerance - self.last_value) / dt
+        if self.upper is not None:
+            upper = min(upper, self.upper)
+            lower = max(lower, self.lower)
+        self.upper = upper
+        self.lower = lower
+        return True
+
+    def offer(self, ts, value):
+        # Returns (ts, value) to keep, or None. The point returned is the
+        # previous sample, once it's known to end a segment.
+        if self.last_ts is None:
+            self._hinge(ts, value)
+            self.prev_ts = ts
+            self.prev_value = value
+            return ts, value
+        if ts <= self.prev_ts:
+            return None
+
+        kept = None
+        pending = self.prev_ts != self.last_ts
+        if pending and (not self._swing(ts, value) or ts - self.last_ts > self.max_interval):
+            # The previous sample ends this segment, and starts the next
+            kept = (self.prev_ts, self.prev_value)
+            self._hinge(self.prev_ts, self.prev_value)
+            self._swing(ts, value)
+        elif not pending:
+            self._swing(ts, value)
+        self.prev_ts = ts
+        self.prev_value = value
+        return kept
+
+    def flush(self):
+        # Keeps the latest sample, e.g. before sending, so the segment is complete
+        if self.prev_ts is None or self.prev_ts == self.last_ts:
+            return None
+        self._hinge(self.prev_ts, self.prev_value)
+        return self.prev_ts, self.prev_value
+
+
+def reconstruct(points, times, linear):
+    """
+    Values at each of times (ascending) from the kept (ts, value) points
+    (ascending), by linear interpolation or by holding the last value.
+    Times before the first point are None.
+    """
+    values = []
+    n = 0
+    for ts in times:
+        while n < len(points) and points[n][0] <= ts:
+            n += 1
+        if n == 0:
+            values.append(None)
+        elif n == len(points) or not linear:
+            values.append(points[n - 1][1])
+        else:
+            t0, v0 = points[n - 1]
+            t1, v1 = points[n]
+            values.append(v0 + (v1 - v0) * (ts - t0) / (t1 - t0))
+    return values
+
+
+class Compressor():
+    def __init__(self, filters=None, capacity=360, max_channels=16):
+        self.filters = {} # channel : Deadband or SwingingDoor
+        if filters:
+            self.filters.update(filters)
+
+        # Kept points, e.g. as Notecard_manager.timestamped_note via output.unsent
+        self.output = SampleStore(capacity=capacity, max_channels=max_channels)
+        self._row_ts = None # timestamp of the output row being filled
+
+        # Counters
+        self.offered = 0
+        self.kept = 0
+
+    def _keep(self, ts, channel, value):
+        output = self.output
+        # Points for the same timestamp are merged into one row, if not yet sent
+        if ts != self._row_ts or len(output.unsent) == 0:
+            # A new row, without the previous row's channels
+            for name in output.keys():
+                del output[name]
+            self._row_ts = ts
+        output[channel] = value
+        output.unsent.append(ts, output)
+        self.kept += 1
+
+    def add(self, ts, datadict):
+        # Returns the number of points kept
+        kept = self.kept
+        earlier = []
+        current = []
+        for channel, value in datadict.items():
+            if isinstance(value, bool):
+                value = int(value) # e.g. pump states
+            elif not isinstance(value, (int, float)):
+                continue
+            self.offered += 1
+            f = self.filters.get(channel)
+            if f is None:
+                current.append((channel, value))
+                continue
+            point = f.offer(ts, value)
+            if point is None:
+                continue
+            if point[0] == ts:
+                current.append((channel, value))
+            else:
+                earlier.append((point[0], channel, point[1]))
+        # Earlier points first, so rows stay in time order
+        earlier.sort()
+        for point_ts, channel, value in earlier:
+            self._keep(point_ts, channel, value)
+        for channel, value in current:
+            self._keep(ts, channel, value)
+        return self.kept - kept
+
+    def flush(self):
+        # Keeps the points the filters are holding back, call before sending
+        # output.unsent so each channel's latest segment is complete
+        held = []
+        for channel, f in self.filters.items():
+            point = f.flush()
+            if point is not None:
+                held.append((point[0], channel, point[1]))
+        held.sort()
+        for ts, channel, value in held:
+            self._keep(ts, channel, value)
+
+    def stats(self):
+        return {
+            "offered" : self.offered,
+            "kept"    : self.kept,
+            "ratio"   : round(self.offered / self.kept, 1) if self.kept else None,
+            "unsent"  : len(self.output.unsent),
+            }
@@ -0,0 +1,130 @@
+"""
+Typed parsing of Notecard environment variables.
+
+Notehub environment variables always arrive as strings. EnvSchema is compiled
+once from a dict of defaults (typed_env), giving a converter per key based on
+the type of its default value. On each update only keys whose raw string has
+changed are re-parsed, and the set of changed keys is returned.
+
+Lists are parsed with parse_list() rather than eval().
+"""
+
+
+def _parse_scalar(token):
+    token = token.strip()
+    if len(token) >= 2 and token[0] == token[-1] and token[0] in "'\"":
+        return token[1:-1]
+    if token == "True":
+        return True
+    if token == "False":
+        return False
+    if token == "None":
+        return None
+    try:
+        return int(token)
+    except ValueError:
+        pass
+    try:
+        return float(token)
+    except ValueError:
+        pass
+    # Be lenient with unquoted strings, e.g. [pump1, pump2]
+    return token
+
+
+def _parse_list(text, i):
+    # Parses a list starting at text[i] == "[", returns (list, index after "]")
+    result = []
+    start = i + 1
+    i += 1
+    quote = None
+    while i < len(text):
+        c = text[i]
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in "'\"":
+            quote = c
+        elif c == "[":
+            item, i = _parse_list(text, i)
+            result.append(item)
+            # skip to the next separator
+            while i < len(text) and text[i] not in ",]":
+                i += 1
+            if i < len(text) and text[i] == "]":
+                return result, i + 1
+            start = i + 1
+        elif c == "," or c == "]":
+            token = text[start:i]
+            if token.strip():
+                result.append(_parse_scalar(token))
+            elif c == ",":
+                raise ValueError(f"empty list item in {text}")
+            if c == "]":
+                return result, i + 1
+            start = i + 1
+        i += 1
+    raise ValueError(f"unterminated list {text}")
+
+
+def parse_list(text):
+    # e.g. "[1, 2.5, 'a', True, [3, 4]]" -> [1, 2.5, 'a', True, [3, 4]]
+    text = text.strip()
+    if not text or text[0] != "[" or text[-1] != "]":
+        raise ValueError(f"{text} is not a list")
+    result, end = _parse_list(text, 0)
+    if end != len(text):
+        raise ValueError(f"unexpected text after list in {text}")
+    return result
+
+
+def parse_bool(text):
+    return text == 'True'
+
+
+def _converter(default):
+    dtype = type(default)
+    if dtype == list:
+        return parse_list
+    if dtype == bool:
+        return parse_bool
+    return dtype
+
+
+class EnvSchema():
+    def __init__(self, typed_env):
+        self.source = typed_env
+        self.converters = {key : _converter(val) for key, val in typed_env.items()}
+        self.raw = {} # key : raw string from the last update
+
+    def update(self, environment, typed_env, log=None):
+        """
+        Parses changed keys from the raw environment into typed_env.
+        Keys without a converter (not in the original typed_env) are kept as strings,
+        except those starting with "_" which are Notehub internals.
+        Returns the set of keys that changed.
+        """
+        changed = set()
+        for key, val in environment.items():
+            if self.raw.get(key) == val:
+                continue
+            self.raw[key] = val
+
+            convert = self.converters.get(key)
+            if convert is None:
+                if key[0] == "_":
+                    continue
+                typed_env[key] = val
+                if log:
+                    log.debug("environment update: %s = %s *unknown type*", key, val)
+            else:
+                try:
+                    typed_env[key] = convert(val)
+                except Exception as e:
+                    if log:
+                        log.error(f"Could not parse {key} = {val}, {e}")
+                    continue
+                if log:
+                    log.debug("environment update: %s = %s", key, typed_env[key])
+            changed.add(key)
+        return changed
@@ -0,0 +1,114 @@
+"""
+Registry of the devices on an I2C bus, keyed by integer address.
+
+A full scan() of 0x08-0x77 is done once, e.g. at boot. After that, check()
+probes only the expected addresses, so a device dropping off (or coming back
+onto) the bus is noticed quickly without rescanning. Each probe is a single
+address write, and a check is skipped if another user (e.g. the Notecard) has
+the bus locked.
+
+Expected devices can be given with hex string keys, as in the examples'
+i2c_dict, e.g. {'0x17' : 'BluesWireless Notecard'}
+"""
+
+
+def to_address(key):
+    # 0x17, "0x17" or "17" (hex) to an int address
+    if isinstance(key, int):
+        return key
+    return int(key, 16)
+
+
+class I2CRegistry():
+    def __init__(self, bus, expected=None, name="i2c"):
+        self.bus = bus
+        self.name = name
+        self.expected = {} # address : description
+        self.present = {} # address : bool, for expected addresses. None until first checked
+        self.unknown = [] # addresses found by scan() that weren't expected
+        self.on_change = None # function(address, present, description)
+
+        # Counters
+        self.scans = 0
+        self.probes = 0
+        self.changes = 0
+        self.busy = 0 # checks skipped because the bus was locked
+
+        if expected:
+            for key, description in expected.items():
+                self.expect(key, description)
+
+    def expect(self, key, description=""):
+        address = to_address(key)
+        self.expected[address] = description
+        self.present.setdefault(address, None) # not yet seen
+
+    def _lock(self, wait):
+        if wait:
+            while not self.bus.try_lock():
+                pass
+            return True
+        return self.bus.try_lock()
+
+    def scan(self):
+        # Full scan, returns the list of addresses found
+        self._lock(wait=True)
+        try:
+            found = self.bus.scan()
+        finally:
+            self.bus.unlock()
+        self.scans += 1
+        for address in self.expected:
+            self._update(address, address in found)
+        self.unknown = [address for address in found if address not in self.expected]
+        return found
+
+    def _probe(self, address):
+        self.probes += 1
+        try:
+            return self.bus.probe(address)
+        except AttributeError:
+            # busio.I2C.probe() was added in CircuitPython 8
+            try:
+                self.bus.writeto(address, b"")
+                return True
+            except OSError:
+                return False
+
+    def check(self):
+        """
+        Probes each expected address. Returns the number of changes, or None
+        if the bus was busy.
+        """
+        if not self._lock(wait=False):
+            self.busy += 1
+            return None
+        changes = 0
+        try:
+            for address in self.expected:
+                if self._update(address, self._probe(address)):
+                    changes += 1
+        finally:
+            self.bus.unlock()
+        return changes
+
+    def _update(self, address, present):
+        previous = self.present.get(address)
+        self.present[address] = present
+        if previous is None or previous == present:
+            return False
+        self.changes += 1
+        if self.on_change:
+            self.on_change(address, present, self.expected.get(address, ""))
+        return True
+
+    def missing(self):
+        return [address for address, present in self.present.items() if not present]
+
+    def stats(self):
+        return {
+            "present" : [address for address, present in self.present.items() if present],
+            "missing" : self.missing(),
+            "unknown" : self.unknown,
+            "changes" : self.changes,
+            }
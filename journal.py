@@ -0,0 +1,149 @@
+"""
+Append-only journal on flash, for notes that could not be sent.
+
+If the Notecard can't be reached, queued notes are spilled here rather than
+held in RAM, so they survive a watchdog reset or reboot, and are replayed to
+the Notecard once it is reachable again.
+
+Each line of the journal is one note: {"f" : notefile, "b" : body}.
+Writes are batched by the caller (e.g. one line per failed send, rather than
+per sample) to limit flash wear. The journal is split into two files,
+<path>.1 (older) and <path>.0 (current). When the current file reaches half of
+max_bytes it is rotated, discarding the older file.
+
+Replay is at-least-once, a reset part way through may resend some notes.
+The filesystem must be writable by CircuitPython, see templates/boot.py
+"""
+
+import os
+import json
+
+
+def _size(name):
+    try:
+        return os.stat(name)[6]
+    except OSError:
+        return None
+
+
+def _remove(name):
+    try:
+        os.remove(name)
+    except OSError:
+        pass
+
+
+class Journal():
+    def __init__(self, path="/journal", max_bytes=32768):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._current = f"{path}.0"
+        self._older = f"{path}.1"
+
+        # Replay cursor, (file, byte offset) of the oldest unsent record
+        self._cursor = (self._older, 0)
+        self._next_offset = 0
+        self.pending_replay = _size(self._older) is not None or _size(self._current) is not None
+
+        # Counters
+        self.bytes_written = 0
+        self.records_written = 0
+        self.rotations = 0
+        self.bytes_discarded = 0 # lost to rotation
+        self.write_errors = 0
+        self.corrupt = 0 # unreadable lines skipped during replay, e.g. a partial write
+
+    def write(self, notefile, body):
+        # Appends one note. Returns False if it couldn't be written, e.g. read only filesystem.
+        return self.write_many(notefile, (body,))
+
+    def write_many(self, notefile, bodies):
+        # Appends one note per body, in a single file write, e.g. templated records
+        lines = "".join(json.dumps({"f" : notefile, "b" : body}) + "\n" for body in bodies)
+        if not lines:
+            return True
+        try:
+            size = _size(self._current) or 0
+            if size and size + len(lines) > self.max_bytes // 2:
+                self._rotate()
+            with open(self._current, "a") as f:
+                f.write(lines)
+        except OSError:
+            self.write_errors += 1
+            return False
+        self.bytes_written += len(lines)
+        self.records_written += lines.count("\n")
+        self.pending_replay = True
+        return True
+
+    def _rotate(self):
+        name, offset = self._cursor
+        older = _size(self._older)
+        if older:
+            # Only the part not yet replayed is lost
+            self.bytes_discarded += older - offset if name == self._older else older
+            _remove(self._older)
+        os.rename(self._current, self._older)
+        self.rotations += 1
+        # Anything not yet replayed is now in the older file
+        if name == self._current:
+            # Same position, the file has just been renamed
+            self._cursor = (self._older, offset)
+        else:
+            # The file being replayed was discarded, start from the current one
+            self._cursor = (self._older, 0)
+            self._next_offset = 0
+
+    def peek(self):
+        """
+        Returns (notefile, body) for the oldest record not yet replayed, or None
+        if there are none. Call advance() once it has been sent.
+        """
+        while True:
+            name, offset = self._cursor
+            line = None
+            try:
+                with open(name, "r") as f:
+                    f.seek(offset)
+                    line = f.readline()
+                    self._next_offset = f.tell()
+            except OSError:
+                # File doesn't exist
+                line = ""
+
+            if not line:
+                # Reached the end of this file, everything in it has been replayed
+                _remove(name)
+                if name == self._older:
+                    self._cursor = (self._current, 0)
+                    continue
+                self._cursor = (self._older, 0)
+                self.pending_replay = False
+                return None
+
+            try:
+                record = json.loads(line)
+                return record["f"], record["b"]
+            except (ValueError, KeyError):
+                self.corrupt += 1
+                self.advance()
+
+    def advance(self):
+        self._cursor = (self._cursor[0], self._next_offset)
+
+    def clear(self):
+        _remove(self._older)
+        _remove(self._current)
+        self._cursor = (self._older, 0)
+        self.pending_replay = False
+
+    def stats(self):
+        return {
+            "bytes"     : (_size(self._older) or 0) + (_size(self._current) or 0),
+            "written"   : self.bytes_written,
+            "records"   : self.records_written,
+            "rotations" : self.rotations,
+            "discarded" : self.bytes_discarded,
+            "errors"    : self.write_errors,
+            "corrupt"   : self.corrupt,
+            }
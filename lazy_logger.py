@@ -0,0 +1,77 @@
+"""
+Level-gated logging on top of adafruit_logging.
+
+adafruit_logging evaluates msg % args before checking the level, so every
+debug message is formatted even when it won't be output. LazyLogger checks
+the level first, so use %-style arguments for anything expensive, e.g.
+
+    self.log.debug("card.status=%s", rsp)
+
+rather than an f-string, which is always built.
+
+format_record() gives the "name LEVEL msg" text for a record, and caches it,
+so the serial, display and Notecard sinks share one string per record.
+"""
+
+import adafruit_logging as logging
+
+DISPLAY = 25 # custom level, for messages to show on an attached display
+
+
+class LazyLogger():
+    def __init__(self, name):
+        self.name = name
+        self.logger = logging.getLogger(name)
+        self.level = logging.NOTSET
+
+    def setLevel(self, level):
+        self.level = level
+        self.logger.setLevel(level)
+
+    def getEffectiveLevel(self):
+        return self.level
+
+    def isEnabledFor(self, level):
+        return level >= self.level
+
+    def addHandler(self, handler):
+        self.logger.addHandler(handler)
+
+    def log(self, level, msg, *args):
+        if level < self.level:
+            return
+        if args:
+            msg = msg % args
+        # adafruit_logging always applies msg % args, which would fail on
+        # text containing "%", so pass the finished text as an argument
+        self.logger.log(level, "%s", msg)
+
+    def debug(self, msg, *args):
+        if logging.DEBUG >= self.level:
+            self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        if logging.INFO >= self.level:
+            self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(logging.ERROR, msg, *args)
+
+    def critical(self, msg, *args):
+        self.log(logging.CRITICAL, msg, *args)
+
+
+_last_record = None
+_last_text = None
+
+
+def format_record(record):
+    # "name LEVEL msg", built once per record however many sinks ask for it
+    global _last_record, _last_text
+    if record is not _last_record:
+        _last_text = f'{record.name} {record.levelname} {record.msg}'
+        _last_record = record
+    return _last_text
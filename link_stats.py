@@ -0,0 +1,109 @@
+"""
+Latency and error statistics for Notecard transactions.
+
+LinkStats.instrument() wraps a Notecard object's Transaction method, which
+every note-python helper (hub.*, card.*, note.*, env.*, file.*) goes through.
+Each request type gets a count, error counts and a small fixed-size latency
+histogram, from which min/mean/max/p95 are reported.
+"""
+
+import time
+
+# Histogram bucket upper bounds in ms, plus an overflow bucket
+BUCKETS_MS = (5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class RequestStats():
+    def __init__(self):
+        self.count = 0
+        self.errors = 0 # responses containing "err"
+        self.exceptions = 0 # e.g. OSError from the I2C bus
+        self.total_ms = 0
+        self.min_ms = None
+        self.max_ms = 0
+        self.histogram = [0] * (len(BUCKETS_MS) + 1)
+
+    def record(self, ms, error=False, exception=False):
+        self.count += 1
+        if error:
+            self.errors += 1
+        if exception:
+            self.exceptions += 1
+        self.total_ms += ms
+        if self.min_ms is None or ms < self.min_ms:
+            self.min_ms = ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+        i = 0
+        for bound in BUCKETS_MS:
+            if ms <= bound:
+                break
+            i += 1
+        self.histogram[i] += 1
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the pth percentile, capped at max_ms
+        if self.count == 0:
+            return None
+        target = self.count * p / 100
+        cumulative = 0
+        for i, n in enumerate(self.histogram):
+            cumulative += n
+            if cumulative >= target:
+                if i < len(BUCKETS_MS):
+                    return min(BUCKETS_MS[i], self.max_ms)
+                break
+        return self.max_ms
+
+    def summary(self):
+        if self.count == 0:
+            return {"n" : 0}
+        return {
+            "n"    : self.count,
+            "err"  : self.errors,
+            "exc"  : self.exceptions,
+            "min"  : round(self.min_ms, 1),
+            "mean" : round(self.total_ms / self.count, 1),
+            "max"  : round(self.max_ms, 1),
+            "p95"  : round(self.percentile(95), 1),
+            }
+
+
+class LinkStats():
+    def __init__(self):
+        self.requests = {} # request type : RequestStats
+
+    def instrument(self, ncard):
+        # Replaces ncard.Transaction with a timed version.
+        # An instance attribute is used (rather than a proxy object) so note-python's
+        # type checks on the card object still pass.
+        transaction = ncard.Transaction
+
+        def timed_transaction(req, *args, **kwargs):
+            name = req.get("req", "unknown")
+            start = time.monotonic_ns()
+            try:
+                rsp = transaction(req, *args, **kwargs)
+            except Exception:
+                self.record(name, (time.monotonic_ns() - start) / 1e6, exception=True)
+                raise
+            error = isinstance(rsp, dict) and "err" in rsp
+            self.record(name, (time.monotonic_ns() - start) / 1e6, error=error)
+            return rsp
+
+        ncard.Transaction = timed_transaction
+
+    def record(self, name, ms, error=False, exception=False):
+        stats = self.requests.get(name)
+        if stats is None:
+            stats = RequestStats()
+            self.requests[name] = stats
+        stats.record(ms, error, exception)
+
+    def summary(self):
+        # e.g. {"card.status" : {"n" : 12, "err" : 0, "exc" : 1, "min" : 8.2, ...}, ...}
+        return {name : stats.summary() for name, stats in self.requests.items()}
+
+    def reset(self):
+        self.requests = {}
@@ -0,0 +1,77 @@
+"""
+Accumulates log lines between sends of the timestamped log, with repeats
+run-length compressed.
+
+Each unique line is stored once, with the first and last timestamp it was seen
+and a count. Traceback text is interned in a separate table, so a traceback
+that appears in several different lines is only stored once.
+
+The note body looks like:
+
+    {"log" : [[first_ts, last_ts, count, text], ...],
+     "tb"  : {"tb0" : "Traceback (most recent call last): ..."}}
+
+where text may contain references like <tb0> to the traceback table.
+"""
+
+_TRACEBACK = "Traceback"
+
+
+class LogAccumulator():
+    def __init__(self, max_entries=100, max_tracebacks=10):
+        self.max_entries = max_entries
+        self.max_tracebacks = max_tracebacks
+
+        # text : [first_ts, last_ts, count]
+        # The dict's string hashing acts as the fingerprint
+        self.entries = {}
+        self.tracebacks = {} # traceback text : reference e.g. "tb0"
+
+        self.dropped = 0 # unique lines discarded because the accumulator was full
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _intern(self, text):
+        # Replaces any traceback in text with a reference to the traceback table
+        i = text.find(_TRACEBACK)
+        if i < 0:
+            return text
+        # format_exception() gives a list, so the repr may start just before "Traceback"
+        if i >= 2 and text[i - 2:i] in ("['", '["'):
+            i -= 2
+        tb = text[i:]
+        ref = self.tracebacks.get(tb)
+        if ref is None:
+            if len(self.tracebacks) >= self.max_tracebacks:
+                return text
+            ref = f"tb{len(self.tracebacks)}"
+            self.tracebacks[tb] = ref
+        return f"{text[:i]}<{ref}>"
+
+    def add(self, text, ts):
+        key = self._intern(text)
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[1] = ts
+            entry[2] += 1
+        elif len(self.entries) < self.max_entries:
+            self.entries[key] = [ts, ts, 1]
+        else:
+            self.dropped += 1
+
+    def as_body(self):
+        log = [[first, last, count, text] for text, (first, last, count) in self.entries.items()]
+        # Timestamps are "YYYY-MM-DD HH:MM:SS" strings, so sort chronologically
+        log.sort(key=lambda e: e[0])
+        body = {"log" : log}
+        if self.tracebacks:
+            body["tb"] = {ref : tb for tb, ref in self.tracebacks.items()}
+        if self.dropped:
+            body["dropped"] = self.dropped
+        return body
+
+    def clear(self):
+        self.entries = {}
+        self.tracebacks = {}
+        self.dropped = 0
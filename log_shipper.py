@@ -0,0 +1,102 @@
+"""
+Rate-limited, batched shipping of log records as Notecard notes.
+
+Records arriving within `window` seconds of the first queued record are
+coalesced into one note body, in the same {timestamp: [text, ...]} form as
+the timestamped log. Notes are limited by a token bucket (`rate` notes per
+second, up to `burst` at once) and by a hard cap of `max_per_hour`.
+If the queue fills up while waiting, the oldest records are dropped.
+"""
+
+import time
+
+
+class LogShipper():
+    def __init__(self, window=10, rate=1/60, burst=3, max_per_hour=20, max_queue=50):
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        self.max_per_hour = max_per_hour
+        self.max_queue = max_queue
+
+        self.queue = [] # (ts, text) tuples, oldest first
+        self._first = 0 # monotonic time the oldest queued record arrived
+
+        self._tokens = burst
+        self._refilled = time.monotonic()
+        self._hour_start = time.monotonic()
+        self._hour_count = 0
+
+        # Counters
+        self.dropped = 0 # records discarded because the queue was full
+        self.notes = 0 # notes shipped
+        self.records = 0 # records shipped
+
+    def __len__(self):
+        return len(self.queue)
+
+    def add(self, ts, text):
+        if not self.queue:
+            self._first = time.monotonic()
+        if len(self.queue) >= self.max_queue:
+            self.queue.pop(0)
+            self.dropped += 1
+        self.queue.append((ts, text))
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        if now - self._hour_start >= 3600:
+            self._hour_start = now
+            self._hour_count = 0
+
+    def ready(self, urgent=False, flush=False):
+        """
+        True if a note can be shipped now. urgent skips the coalescing window
+        and token bucket, but not the hourly cap. flush only skips the window.
+        """
+        if not self.queue:
+            return False
+        now = time.monotonic()
+        self._refill(now)
+        if self._hour_count >= self.max_per_hour:
+            return False
+        if urgent:
+            return True
+        return self._tokens >= 1 and (flush or now - self._first >= self.window)
+
+    def take(self):
+        # Returns a note body for everything queued, and charges it to the limits
+        body = {}
+        for ts, text in self.queue:
+            if ts in body:
+                body[ts].append(text)
+            else:
+                body[ts] = [text]
+        self.records += len(self.queue)
+        self.notes += 1
+        self.queue = []
+        self._tokens = max(0, self._tokens - 1)
+        self._hour_count += 1
+        return body
+
+    def requeue(self, body):
+        # Puts back a body from take() that could not be sent.
+        # The attempt still counts against the rate limits.
+        pending = self.queue
+        self.queue = []
+        for ts, texts in body.items():
+            for text in texts:
+                self.add(ts, text)
+                self.records -= 1
+        for ts, text in pending:
+            self.add(ts, text)
+        self.notes -= 1
+
+    def stats(self):
+        return {
+            "queued"  : len(self.queue),
+            "notes"   : self.notes,
+            "records" : self.records,
+            "dropped" : self.dropped,
+            }
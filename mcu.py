@@ -19,6 +19,15 @@ import busio
 import digitalio
 import analogio
 
+from circuitpy_mcu.scheduler import Scheduler
+from circuitpy_mcu.alarms import AlarmSchedule
+from circuitpy_mcu.serial_lines import LineAssembler, CommandTable
+from circuitpy_mcu.telemetry import TelemetryStream
+from circuitpy_mcu.lazy_logger import LazyLogger, format_record, DISPLAY
+from circuitpy_mcu.clock import clock
+from circuitpy_mcu.i2c_registry import I2CRegistry, to_address
+from circuitpy_mcu.sample_store import SampleStore
+
 try:
     # Import Known display types
     from circuitpy_mcu.display import LCD_16x2, LCD_20x4
@@ -30,24 +39,41 @@ __version__ = "v3.2.1"
 __repo__ = "https://github.com/calcut/circuitpy-mcu"
 
 class Mcu():
-    def __init__(self, i2c_freq=50000, i2c_lookup=None, uart_baud=None, loglevel=logging.INFO):
+    def __init__(self, i2c_freq=50000, i2c_lookup=None, uart_baud=None, loglevel=logging.INFO,
+                 data_capacity=360, data_channels=16):
 
         uid = microcontroller.cpu.uid
         self.id = f'{uid[-2]:02x}{uid[-1]:02x}'
 
         self.display = None
-        self.serial_buffer = ''
-        self.data = {} # A dict to store datapoints as they are captured
+
+        # Serial input, see read_serial() and serial_lines.py
+        self.serial_lines = LineAssembler(max_line=256)
+        self.serial_commands = CommandTable()
+        self.serial_pending = [] # lines waiting to be returned by read_serial()
+        self.serial_pending_max = 8
+        self._serial_send_to = None
+        self._on_serial_line = self._serial_line # bound once, not per call
+
+        # Optional binary stream of self.data, see enable_telemetry()
+        self.telemetry = None
+        # Datapoints as they are captured. Used like a dict, with the history of
+        # each channel kept in preallocated arrays, see sample_store.py
+        self.data = SampleStore(capacity=data_capacity, max_channels=data_channels)
 
         # Real Time Clock in ESP32-S2 can be used to track timestamps
         self.rtc = rtc.RTC()
+        # Per-second cache of the formatted time, shared with Notecard_manager. See clock.py
+        self.clock = clock
 
         # Set up logging
         # See McuLogHandler for details
-        self.log = logging.getLogger('mcu')
+        # Use %-style args for debug messages, they're only formatted if output
+        self.log = LazyLogger('mcu')
         self.loghandler = McuLogHandler(self)
         self.log.addHandler(self.loghandler)
         self.log.setLevel(loglevel)
+        self.data.on_full = self._data_full
 
         # Pull the I2C power pin low to enable I2C power
         self.log.info('Powering up I2C bus')
@@ -64,6 +90,13 @@ class Mcu():
 
         self.i2c2 = None
 
+        # Devices on each bus, keyed by int address, see i2c_identify() and i2c_registry.py
+        self.i2c_registry = I2CRegistry(self.i2c, name="i2c")
+        self.i2c_registry.on_change = self._i2c_changed
+        self.i2c2_registry = None
+        self.i2c_check_interval = 1 # seconds between re-probing expected devices
+        self._i2c_check_task = None
+
         if uart_baud:
             self.uart = busio.UART(board.TX, board.RX, baudrate=uart_baud)
         else:
@@ -85,9 +118,18 @@ class Mcu():
         self.led.direction = digitalio.Direction.OUTPUT
         self.led.value = False
 
+        # Periodic and one-shot tasks, run from service(). See scheduler.py
+        self.scheduler = Scheduler(watchdog_feed=self.watchdog_feed, log=self.log)
+
+        if i2c_lookup:
+            self.i2c_identify(i2c_lookup)
+
+        self._alarm_schedule = None # compiled by get_next_alarm()
+
     def service(self, serial_parser=None):
         self.watchdog_feed()
         self.read_serial(send_to=serial_parser)
+        self.scheduler.run()
 
     def watchdog_feed(self):
         try:
@@ -96,6 +138,26 @@ class Mcu():
             # Happens if watchdog timer hasn't been started
             pass
 
+    def enable_telemetry(self, max_channels=16):
+        """
+        Streams self.data as binary frames on the usb_cdc.data port each time
+        stream_data() is called. Read on the host with telemetry_reader.py
+        usb_cdc.data must be enabled in boot.py, see telemetry.py
+        """
+        if usb_cdc.data is None:
+            self.log.warning('usb_cdc.data is not enabled, telemetry unavailable')
+            return False
+        self.telemetry = TelemetryStream(usb_cdc.data, max_channels=max_channels)
+        return True
+
+    def stream_data(self):
+        # Sends the current self.data, if telemetry is enabled. Values must be numeric.
+        if self.telemetry:
+            try:
+                self.telemetry.send(self.data)
+            except Exception as e:
+                self.handle_exception(e)
+
     def i2c_power_on(self):
         self.i2c_power.switch_to_output(value=(not self.i2c_off_level))
         time.sleep(1.5) # Sometimes even 1s is not enough for e.g. i2c displays. Worse in the heat?
@@ -110,48 +172,69 @@ class Mcu():
         e.g. Notecard i2c comms will fail if there are too many pull-up resistors
         """
         self.i2c2 = busio.I2C(sda=sda, scl=scl, frequency=frequency)
+        self.i2c2_registry = I2CRegistry(self.i2c2, name="i2c2")
+        self.i2c2_registry.on_change = self._i2c_changed
 
     def i2c_identify(self, i2c_lookup=None, i2c=None):
-        if i2c is None:
-            i2c=self.i2c
+        """
+        Scans the bus and logs the devices found.
+        If i2c_lookup is provided, e.g. {'0x17' : 'BluesWireless Notecard'}, those
+        devices are added to the bus registry, and re-probed by i2c_check() every
+        i2c_check_interval seconds, without a full scan.
 
-        while not i2c.try_lock():  pass
+        Returns {key : present} for each key in i2c_lookup, or None
+        """
+        registry = self._i2c_registry_for(i2c)
+        if i2c_lookup:
+            for key, description in i2c_lookup.items():
+                registry.expect(key, description)
+
+        found = registry.scan()
 
         if i2c_lookup:
             self.log.info(f'\nChecking if expected I2C devices are present:')
-            
-            lookup_result = i2c_lookup.copy()
-            devs_present = []
-            for addr in i2c.scan():
-                devs_present.append(f'0x{addr:0{2}X}')
-
-            for addr_hex in i2c_lookup:
-                if addr_hex in devs_present:
-                    lookup_result[addr_hex] = True
-                    devs_present.remove(addr_hex)
-                else:
-                    lookup_result[addr_hex] = False
-            
-                self.log.info(f'{addr_hex} : {i2c_lookup[addr_hex]} = {lookup_result[addr_hex]}')
-                
-            if len(devs_present) > 0:
-                self.log.info(f'Unknown devices found: {devs_present}')
+            lookup_result = {}
+            for key, description in i2c_lookup.items():
+                lookup_result[key] = registry.present[to_address(key)]
+                self.log.info(f'{key} : {description} = {lookup_result[key]}')
 
+            if registry.unknown:
+                self.log.info(f'Unknown devices found: {[f"0x{a:02X}" for a in registry.unknown]}')
+
+            if self._i2c_check_task is None:
+                self._i2c_check_task = self.scheduler.every(self.i2c_check_interval, self.i2c_check)
         else:
-            for device_address in i2c.scan():
-                addr_hex = f'0x{device_address:0{2}X}'
-                self.log.info(f'{addr_hex}')
+            for device_address in found:
+                self.log.info(f'0x{device_address:02X}')
             lookup_result = None
 
-        i2c.unlock()
         return lookup_result
 
+    def _i2c_registry_for(self, i2c):
+        if i2c is None or i2c is self.i2c:
+            return self.i2c_registry
+        if i2c is self.i2c2:
+            return self.i2c2_registry
+        return I2CRegistry(i2c)
+
+    def i2c_check(self):
+        # Re-probes the expected devices on each bus, run by the scheduler
+        for registry in (self.i2c_registry, self.i2c2_registry):
+            if registry and registry.expected:
+                registry.check()
+
+    def _data_full(self, name):
+        self.log.warning(f'mcu.data has {self.data.max_channels} channels, {name} is kept in a dict per sample. See data_channels')
+
+    def _i2c_changed(self, address, present, description):
+        if present:
+            self.log.info(f'I2C device 0x{address:02X} {description} connected')
+        else:
+            self.log.warning(f'I2C device 0x{address:02X} {description} not responding')
+
 
     def get_timestamp(self, utc_offset_hours=0):
-        t = self.rtc.datetime
-        t = time.localtime(time.mktime(t)+utc_offset_hours*60*60)
-        string = f'{t.tm_year}-{t.tm_mon:02}-{t.tm_mday:02} {t.tm_hour:02}:{t.tm_min:02}:{t.tm_sec:02}'
-        return string
+        return self.clock.timestamp(utc_offset_hours)
 
     def attach_display(self, display_object, showtext=None):
         try:
@@ -200,38 +283,39 @@ class Mcu():
         Checks if there is any input on the usb serial port.
         Typically this would be a keyboard input as part of a user interface.
 
-        If a complete line is detected, it will pass the string to the function: send_to()
+        Complete lines starting with a command in self.serial_commands are
+        passed to its handler. Any other line is passed to the function: send_to(),
+        or if not provided, returned (one per call, any others are kept for later calls)
         """
-        serial = usb_cdc.console
-        text = ''
-        available = serial.in_waiting
-        while available:
-            raw = serial.read(available)
-            text = raw.decode("utf-8")
-            print(text, end='')
-            available = serial.in_waiting
-
-        # Sort out line endings
-        if text.endswith("\r"):
-            text = text[:-1]+"\n"
-        if text.endswith("\r\n"):
-            text = text[:-2]+"\n"
-
-        if "\r" in text:
-            self.log.debug(f'carriage return \r found in {bytearray(text)}')
-
-        self.serial_buffer += text
-        if self.serial_buffer.endswith("\n"):
-            input_line = self.serial_buffer[:-1]
-            # clear buffer
-            self.serial_buffer = ""
-            # handle input
+        self._serial_send_to = send_to
+        try:
+            self.serial_lines.read(usb_cdc.console, self._on_serial_line, echo=True)
+        except Exception as e:
+            self.handle_exception(e)
+        self._serial_send_to = None
+
+        if self.serial_pending:
+            input_line = self.serial_pending.pop(0)
             if send_to:
-                # Call the funciton provided with input_line as argument
                 send_to(input_line)
             else:
-                self.log.debug(f'you typed: {input_line}')
+                self.log.debug('you typed: %s', input_line)
                 return input_line
+
+    def _serial_line(self, line):
+        try:
+            if self.serial_commands.dispatch(line):
+                return
+        except Exception as e:
+            self.log.error(f'Error in serial command "{line}": {e}')
+            return
+        if self._serial_send_to:
+            # Call the funciton provided with input_line as argument
+            self._serial_send_to(line)
+        elif len(self.serial_pending) < self.serial_pending_max:
+            self.serial_pending.append(line)
+        else:
+            self.log.warning(f'serial input discarded: {line}')
     
     def get_serial_line(self, valid_inputs=None):
 
@@ -275,37 +359,20 @@ class Mcu():
         """
         Returns number of seconds until the next alarm in a list,
         e.g. alarm_list = ["10:00", "11:00", "14:53"]
-        Assumes alarms repeat daily
+        Assumes alarms repeat daily, unless weekday / interval / cron rules are used,
+        see alarms.py
 
         can provide UTC offset hours, to specify how many hours ahead of UTC the alarm list is
-        """
-
-        now = time.localtime()
-        year = now.tm_year
-        month = now.tm_mon
-        day = now.tm_mday
 
-        seconds_list = []
-
-        for t in alarm_list:
-            sp = t.split(":")
-
-            hour = int(sp[0])
-            mins = int(sp[1])
-
-            alarm_time = time.struct_time([year,month,day,hour,mins, 0,0,0,0])
-            posix_alarm_time = time.mktime(alarm_time) - utc_offset_hours*60*60
-            seconds_to_alarm =  posix_alarm_time - time.mktime(now)
-
-            # roll over to the next day
-            if seconds_to_alarm <=0:
-                seconds_to_alarm += 60*60*24
-
-            seconds_list.append(seconds_to_alarm)
-
-        next_alarm_countdown = min(seconds_list)
-
-        return next_alarm_countdown
+        The list is compiled on the first call and whenever it changes, so this is
+        cheap to call every loop. Or use an AlarmSchedule directly.
+        """
+        schedule = self._alarm_schedule
+        if schedule is None or schedule.source != tuple(alarm_list):
+            schedule = AlarmSchedule(alarm_list)
+            self._alarm_schedule = schedule
+        schedule.utc_offset_hours = utc_offset_hours
+        return schedule.seconds_until_next()
 
 
 class McuLogHandler(logging.Handler):
@@ -316,20 +383,19 @@ class McuLogHandler(logging.Handler):
 
     def emit(self, record):
 
-        if record.levelno == 25:
+        if record.levelno == DISPLAY:
             # Special handling for messages to be displayed on an attached display
             self.device.display_text(record.msg)
             return
 
+        # Print to Serial
         if record.levelno == logging.INFO:
             # Don't include the "INFO" in the string, because this used a lot,
             # and is effectively the default.
-            text = f'{record.name} {record.msg}'
+            print(record.name, record.msg)
         else:
-            text = f'{record.name} {record.levelname} {record.msg}'
-
-        # Print to Serial
-        print(text)
+            # Shared with the aux log function, see lazy_logger.py
+            print(format_record(record))
 
         if self.aux_log_function is not None:
             # to call an auxilliary log output function (e.g. Send via Notecard)
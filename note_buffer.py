@@ -0,0 +1,181 @@
+"""
+A fixed-capacity buffer for timestamped samples waiting to be sent via the Notecard.
+
+Storage is preallocated as a ring, so a long outage can't grow the heap without
+bound. When the entry or byte budget is exceeded, an eviction policy decides
+what to lose:
+
+    DROP_OLDEST       - discard the oldest sample (default)
+    DROP_NEWEST       - keep the existing backlog, reject the incoming sample
+    DOWNSAMPLE_OLDEST - discard every other sample in the oldest half,
+                        keeping coarse coverage of the whole outage
+"""
+
+import gc
+
+from circuitpy_mcu.note_encoding import encode_columnar
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+DOWNSAMPLE_OLDEST = "downsample_oldest"
+
+# gc.mem_alloc() is CircuitPython/MicroPython only
+_mem_alloc = getattr(gc, 'mem_alloc', None)
+
+
+def estimate_size(ts, sample):
+    # Approximate size in bytes of {ts: sample} once serialised to JSON,
+    # without actually building the string.
+    size = len(str(ts)) + 4
+    for key, val in sample.items():
+        size += len(key) + 4
+        if isinstance(val, str):
+            size += len(val) + 2
+        else:
+            size += len(str(val))
+    return size
+
+
+class NoteBuffer():
+    def __init__(self, max_entries=360, max_bytes=16384, policy=DROP_OLDEST):
+        if policy not in (DROP_OLDEST, DROP_NEWEST, DOWNSAMPLE_OLDEST):
+            raise ValueError(f"Unknown eviction policy {policy}")
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy
+
+        self._ts = [0] * max_entries
+        self._samples = [None] * max_entries
+        self._sizes = [0] * max_entries
+        self._heap = [0] * max_entries
+        self._head = 0 # index of the oldest entry
+        self._count = 0
+
+        self.bytes_used = 0 # estimated serialised size of the buffered samples
+        self.heap_used = 0 # heap allocated by the buffered samples
+
+        # Counters, not reset by clear()
+        self.dropped = 0 # samples lost to DROP_OLDEST / DROP_NEWEST, or too large to fit
+        self.downsampled = 0 # samples lost to DOWNSAMPLE_OLDEST
+
+    def __len__(self):
+        return self._count
+
+    def _index(self, n):
+        # ring index of the nth oldest entry
+        return (self._head + n) % self.max_entries
+
+    def append(self, ts, datadict):
+        """
+        Copies datadict into the buffer under timestamp ts.
+        Returns False if the sample was rejected.
+        """
+        size = estimate_size(ts, datadict)
+        if size > self.max_bytes:
+            self.dropped += 1
+            return False
+
+        if self._count and self._ts[self._index(self._count - 1)] == ts:
+            # Same timestamp as the newest entry, overwrite it as a dict would
+            self._pop_newest()
+
+        while self._count >= self.max_entries or self.bytes_used + size > self.max_bytes:
+            if self.policy == DROP_NEWEST:
+                self.dropped += 1
+                return False
+            elif self.policy == DOWNSAMPLE_OLDEST and self._count >= 4:
+                self._downsample()
+            else:
+                self._pop_oldest()
+                self.dropped += 1
+
+        if _mem_alloc:
+            before = _mem_alloc()
+            sample = datadict.copy()
+            heap = _mem_alloc() - before
+        else:
+            sample = datadict.copy()
+            heap = size
+
+        i = self._index(self._count)
+        self._ts[i] = ts
+        self._samples[i] = sample
+        self._sizes[i] = size
+        self._heap[i] = heap
+        self._count += 1
+        self.bytes_used += size
+        self.heap_used += heap
+        return True
+
+    def _release(self, i):
+        self.bytes_used -= self._sizes[i]
+        self.heap_used -= self._heap[i]
+        self._samples[i] = None
+
+    def _pop_oldest(self):
+        self._release(self._head)
+        self._head = self._index(1)
+        self._count -= 1
+
+    def _pop_newest(self):
+        self._release(self._index(self._count - 1))
+        self._count -= 1
+
+    def _downsample(self):
+        # Remove every other entry in the oldest half, then close the gaps
+        half = self._count // 2
+        dst = 0
+        for n in range(self._count):
+            src = self._index(n)
+            if n < half and n % 2:
+                self._release(src)
+                self.downsampled += 1
+                continue
+            if dst != n:
+                d = self._index(dst)
+                self._ts[d] = self._ts[src]
+                self._samples[d] = self._samples[src]
+                self._sizes[d] = self._sizes[src]
+                self._heap[d] = self._heap[src]
+                self._samples[src] = None
+            dst += 1
+        self._count = dst
+
+    def discard_oldest(self, n):
+        # e.g. after the oldest n entries have been sent
+        for _ in range(min(n, self._count)):
+            self._pop_oldest()
+
+    def entries(self):
+        # Yields (ts, sample) tuples, oldest first
+        for n in range(self._count):
+            i = self._index(n)
+            yield self._ts[i], self._samples[i]
+
+    def as_dict(self):
+        # In the {ts: sample} form used for timestamped note bodies
+        return {ts: sample for ts, sample in self.entries()}
+
+    def columnar(self, scales=None):
+        # In the compact form from note_encoding.py
+        return encode_columnar(self.entries(), scales=scales)
+
+    def clear(self):
+        for n in range(self._count):
+            self._samples[self._index(n)] = None
+        self._head = 0
+        self._count = 0
+        self.bytes_used = 0
+        self.heap_used = 0
+
+    def stats(self):
+        return {
+            "entries"     : self._count,
+            "max_entries" : self.max_entries,
+            "bytes"       : self.bytes_used,
+            "max_bytes"   : self.max_bytes,
+            "heap"        : self.heap_used,
+            "dropped"     : self.dropped,
+            "downsampled" : self.downsampled,
+            }
@@ -0,0 +1,108 @@
+"""
+Compact columnar encoding for timestamped notes.
+
+The default timestamped note body repeats every channel name and the full
+posix timestamp for every sample:
+
+    {1672531200: {"temp": 21.53, "humidity": 55.1}, 1672531260: {...}, ...}
+
+The columnar form stores one base epoch, integer offsets from it, and one
+array per channel. Float channels are sent as fixed-point integers, with the
+scale factor recorded once per channel:
+
+    {"fmt": "col1",
+     "t0": 1672531200,
+     "dt": [0, 60, ...],
+     "c": {"temp": [2153, ...], "humidity": [5510, ...]},
+     "s": {"temp": 100, "humidity": 100}}
+
+Channels missing from a sample are sent as null.
+Integer, boolean and string channels are sent unscaled.
+
+This module has no CircuitPython dependencies, so decode_columnar() can be
+used host-side. See docs/notehub_jsonata_processing.txt for a Notehub route
+equivalent.
+"""
+
+FORMAT = "col1"
+DEFAULT_SCALE = 100 # i.e. 2 decimal places
+
+
+def encode_columnar(entries, scales=None, default_scale=DEFAULT_SCALE):
+    """
+    entries is an iterable of (ts, sample_dict) tuples, e.g. NoteBuffer.entries()
+    scales can override the fixed-point scale factor for individual channels.
+    """
+    times = []
+    samples = []
+    for ts, sample in entries:
+        times.append(ts)
+        samples.append(sample)
+
+    if not times:
+        return {}
+
+    t0 = min(times)
+
+    # A channel is scaled if any of its values is a float
+    scaled = {}
+    for sample in samples:
+        for key, val in sample.items():
+            if isinstance(val, float):
+                scaled[key] = True
+            elif key not in scaled:
+                scaled[key] = False
+
+    columns = {}
+    scale_factors = {}
+    for key, is_float in scaled.items():
+        column = []
+        if is_float:
+            scale = default_scale
+            if scales and key in scales:
+                scale = scales[key]
+            scale_factors[key] = scale
+            for sample in samples:
+                val = sample.get(key)
+                if val is None:
+                    column.append(None)
+                else:
+                    column.append(round(val * scale))
+        else:
+            for sample in samples:
+                column.append(sample.get(key))
+        columns[key] = column
+
+    body = {
+        "fmt" : FORMAT,
+        "t0"  : t0,
+        "dt"  : [ts - t0 for ts in times],
+        "c"   : columns,
+        }
+    if scale_factors:
+        body["s"] = scale_factors
+    return body
+
+
+def decode_columnar(body):
+    """
+    Returns the equivalent {ts: sample_dict} form.
+    Bodies that aren't columnar are returned unchanged.
+    """
+    if body.get("fmt") != FORMAT:
+        return body
+
+    t0 = body["t0"]
+    scale_factors = body.get("s", {})
+    result = {}
+    for i, offset in enumerate(body["dt"]):
+        sample = {}
+        for key, column in body["c"].items():
+            val = column[i]
+            if val is None:
+                continue
+            if key in scale_factors:
+                val = val / scale_factors[key]
+            sample[key] = val
+        result[t0 + offset] = sample
+    return result
@@ -0,0 +1,140 @@
+"""
+Notecard note.template support.
+
+Templated notes are stored by the Notecard as fixed-length binary records,
+which are much smaller than free-form JSON. The template is derived from the
+keys and value types of a sample (e.g. mcu.data), registered once per notefile
+and cached. If the channel set or a channel's type changes, the notefile is
+re-templated on the next send. Within a batch, the notefile is re-templated at
+the start of each run of samples with the same channels, rather than filling in
+values for the missing ones. A channel that is a float anywhere in the batch is
+templated as a float throughout, see float_channels().
+None values are treated as missing channels. Samples with values that can't be
+templated (e.g. lists) are sent untemplated, after removing the template.
+
+The "compact" format is used, so each record can carry its own _time, which
+lets timestamped samples be sent one record each without losing their
+timestamps.
+https://dev.blues.io/api-reference/notecard-api/note-requests/#note-template
+"""
+
+# Template type indicators, see the Notecard API reference
+TEMPLATE_BOOL = True
+TEMPLATE_INT = 14 # 4 byte signed integer
+TEMPLATE_FLOAT = 14.1 # 4 byte float
+TEMPLATE_STRING = "x" # variable length string (Notecard FW 3.2.1+)
+TEMPLATE_TIME = 14
+
+
+def _type_code(val):
+    # bool must be checked before int, as it is a subclass
+    if isinstance(val, bool):
+        return "b"
+    if isinstance(val, int):
+        return "i"
+    if isinstance(val, float):
+        return "f"
+    if isinstance(val, str):
+        return "s"
+    return None
+
+
+def template_signature(datadict, floats=()):
+    # Cheap to compare, identifies the channel set and value types.
+    # Int channels in floats are templated as floats.
+    signature = []
+    for key, val in datadict.items():
+        if val is None:
+            continue
+        code = _type_code(val)
+        if code == "i" and key in floats:
+            code = "f"
+        signature.append((key, code))
+    return tuple(sorted(signature))
+
+
+def float_channels(samples):
+    # The channels that are a float in any of samples, so a channel that
+    # switches between int and float doesn't split a batch into more runs
+    floats = set()
+    for sample in samples:
+        for key, val in sample.items():
+            if isinstance(val, float):
+                floats.add(key)
+    return floats
+
+
+def make_record(sample, ts, floats=()):
+    # The templated record for sample, without its missing channels
+    body = {}
+    for key, val in sample.items():
+        if val is None:
+            continue
+        if key in floats and isinstance(val, int) and not isinstance(val, bool):
+            val = float(val)
+        body[key] = val
+    body["_time"] = ts
+    return body
+
+
+def derive_template(signature):
+    template = {"_time" : TEMPLATE_TIME}
+    for key, code in signature:
+        if code == "b":
+            template[key] = TEMPLATE_BOOL
+        elif code == "i":
+            template[key] = TEMPLATE_INT
+        elif code == "f":
+            template[key] = TEMPLATE_FLOAT
+        elif code == "s":
+            template[key] = TEMPLATE_STRING
+        else:
+            raise TypeError(f"Can't template {key}, unsupported type")
+    return template
+
+
+class NoteTemplates():
+    def __init__(self, files=("data.qo",)):
+        self.files = files
+        self.registered = {} # notefile : signature currently registered on the card
+
+    def ensure(self, ncard, notefile, datadict=None, signature=None):
+        """
+        Registers a template for notefile if the card doesn't have one matching
+        the datadict (or signature). Returns False if the card rejected it.
+        """
+        if signature is None:
+            signature = template_signature(datadict)
+        if signature == self.registered.get(notefile):
+            return True
+
+        req = {"req": "note.template"}
+        req["file"] = notefile
+        req["format"] = "compact"
+        req["body"] = derive_template(signature)
+        rsp = ncard.Transaction(req)
+        if "err" in rsp:
+            self.registered.pop(notefile, None)
+            return False
+
+        self.registered[notefile] = signature
+        return True
+
+    def remove(self, ncard, notefile):
+        # Removes notefile's template, so it accepts untemplated notes.
+        # Returns False if the card rejected it.
+        if notefile in self.registered and self.registered[notefile] is None:
+            return True
+        rsp = ncard.Transaction({"req": "note.template", "file": notefile})
+        if "err" in rsp:
+            self.registered.pop(notefile, None)
+            return False
+        self.registered[notefile] = None # known to have no template
+        return True
+
+    def forget(self, notefile=None):
+        # Force re-templating, e.g. after the Notecard has been restored
+        if notefile is None:
+            self.registered = {}
+        else:
+            self.registered.pop(notefile, None)
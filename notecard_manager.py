@@ -11,18 +11,66 @@ from notecard import hub, card, file, note, env
 
 from secrets import secrets, notecard_config
 
+from circuitpy_mcu.persist import fnv1a32, nvm_read, nvm_write, NVM_CONFIG_HASH
+from circuitpy_mcu.persist import NVM_SYNC_FAILURES, NVM_SYNC_RETRY_AT, NVM_RECONF_FAILURES, NVM_RECONF_OPEN_UNTIL
+
+from circuitpy_mcu.note_buffer import NoteBuffer, DROP_OLDEST
+from circuitpy_mcu.note_template import NoteTemplates, float_channels, make_record, template_signature
+from circuitpy_mcu.link_stats import LinkStats
+from circuitpy_mcu.log_shipper import LogShipper
+from circuitpy_mcu.log_accumulator import LogAccumulator
+from circuitpy_mcu.env_schema import EnvSchema
+from circuitpy_mcu.journal import Journal
+from circuitpy_mcu.sync_policy import SyncPolicy
+from circuitpy_mcu.backoff import Backoff, CircuitBreaker
+from circuitpy_mcu.lazy_logger import LazyLogger, format_record, DISPLAY
+from circuitpy_mcu.clock import clock
+from circuitpy_mcu.aggregator import Aggregator
+from circuitpy_mcu.compression import Compressor
+
+
+# States for the non-blocking status / sync state machine, see service()
+STATUS_IDLE = "idle"
+STATUS_CHECK = "check"
+STATUS_TRACE_START = "trace_start"
+STATUS_SYNC = "sync"
+STATUS_TRACE_STOP = "trace_stop"
+STATUS_SYNC_STATUS = "sync_status"
+STATUS_RECONF_HUB = "reconf_hub"
+STATUS_RECONF_VERSION = "reconf_version"
+STATUS_RECONF_WIFI = "reconf_wifi"
+STATUS_RECONF_RESTART = "reconf_restart"
+STATUS_RESTART_WAIT = "restart_wait"
+
+# Reference point for boot_metrics, approximately when code.py started
+_BOOT_TIME = time.monotonic()
+
+
+def config_hash():
+    # Identifies the notecard_config and wifi credentials that were applied
+    text = repr(sorted(notecard_config.items())) + secrets['ssid'] + secrets['password']
+    return fnv1a32(text)
+
 
 class Notecard_manager():
-    def __init__(self, loghandler=None, i2c=None, debug=False, loglevel=logging.INFO, watchdog=False):
+    def __init__(self, loghandler=None, i2c=None, debug=False, loglevel=logging.INFO, watchdog=False,
+                 note_max_entries=360, note_max_bytes=16384, note_policy=DROP_OLDEST,
+                 templates=False, fast_start=True, journal_path=None, journal_max_bytes=32768,
+                 sync_policy=None, sample_store=None):
         try:
             # Set up logging
-            self.log = logging.getLogger('notecard')
+            # Use %-style args for debug messages, they're only formatted if output
+            self.log = LazyLogger('notecard')
             self.log.setLevel(loglevel)
 
             self.ncard=None
 
+            # Latency / error statistics for every Notecard transaction
+            self.link_stats = LinkStats()
+
             if i2c:
                 self.ncard = notecard.OpenI2C(i2c, 0, 0, debug=debug)
+                self.link_stats.instrument(self.ncard)
             else:
                 self.log.critical('an I2C bus must be provided')
 
@@ -34,23 +82,124 @@ class Notecard_manager():
 
             # Real Time Clock in ESP32-S2 can be used to track timestamps
             self.rtc = rtc.RTC()
+            self.clock = clock # shared per-second cache, see clock.py
 
             self.mode = "continuous"
 
             self.environment = {}
             self.env_stamp = 0 #posix time of last update from notehub
-
-            self.inbound_notes = {'data.qi'  : None}
-
-            self.timestamped_note = {}
-            self.timestamped_log = {}
+            self._env_schema = None
+
+            self.inbound_notes = {'data.qi'  : None} # latest body received per notefile
+            self.inbound_queue = {'data.qi' : []} # FIFO of received bodies per notefile
+            self.inbound_backlog = {'data.qi' : 0} # notes still waiting on the Notecard
+            self.inbound_max_queue = 20 # oldest dropped beyond this, e.g. if not popped
+            self.inbound_dropped = 0
+
+            # Handlers registered with subscribe_note() / subscribe_env(), see dispatch()
+            self.note_handlers = {} # notefile : [handler(body), ...]
+            self.env_handlers = {} # key : [handler(key, value), ...]
+
+            # Bounded, so an outage can't exhaust the heap. See note_buffer.py
+            # Given mcu.data, samples are kept in its arrays instead and the
+            # note_* limits don't apply. See sample_store.py
+            if sample_store is not None:
+                self.timestamped_note = sample_store.unsent
+            else:
+                self.timestamped_note = NoteBuffer(max_entries=note_max_entries,
+                                                   max_bytes=note_max_bytes,
+                                                   policy=note_policy)
+            # Repeated lines are run-length compressed, see log_accumulator.py
+            self.timestamped_log = LogAccumulator()
+
+            # Optionally spill unsent notes to flash, to survive a reset. See journal.py
+            # Requires CIRCUITPY to be writable by CircuitPython, e.g. journal_path="/journal"
+            self.journal = None
+            if journal_path:
+                self.journal = Journal(journal_path, journal_max_bytes)
+            # While the card can't be reached, queued samples are spilled this often,
+            # rather than waiting for the next send to fail
+            self.journal_every = 10
+            self.card_reachable = True
+            self._spill_format = (False, None) # compact, scales of the last send
+
+            # Optionally queue windowed summaries instead of samples, see enable_aggregation()
+            self.aggregator = None
+            # Or only the points needed to reconstruct each channel, see enable_compression()
+            self.compressor = None
+
+            # Decides when send_if_due() flushes notes and requests a sync, see sync_policy.py
+            self.sync_policy = sync_policy
+            if sync_policy is None:
+                self.sync_policy = SyncPolicy(flush_bytes=note_max_bytes // 2)
+
+            # WARNING+ log records are batched and rate limited, see log_shipper.py
+            self.log_shipper = LogShipper()
+            self._shipping_logs = False
+            self._urgent_logs = False # a CRITICAL record is waiting for the next idle service()
+
+            # Optionally send data notes as Notecard templated (binary) records
+            # See note_template.py
+            self.note_templates = None
+            if templates:
+                self.note_templates = NoteTemplates()
 
             self.connected = False
             self.last_sync = 0
+            self.storage = 0 # percentage, from the last card.status
+
+            # Non-blocking status / sync state machine, see service()
+            self.status_state = STATUS_IDLE
+            self.status_latency = {} # state : worst case seconds for that step
+            self.service_latency_max = 0
+            self._nosync_timeout = None
+            self._nosync_warning = None
+            self._debug_trace = None
+            self._restart_until = 0
+            # After an I2C error in service(), card work is paused until this deadline
+            # rather than sleeping, see handle_exception()
+            self.error_backoff = 1 # seconds
+            self._error_until = 0
+            self._nonblocking = False
+
+            # Space out sync attempts while not connected, and limit reconfigure/restart
+            # cycles in poor coverage. Persisted in NVM, see backoff.py
+            self.sync_backoff = Backoff(base=60, max_delay=3600,
+                                        nvm_failures=NVM_SYNC_FAILURES,
+                                        nvm_retry_at=NVM_SYNC_RETRY_AT)
+            self.reconf_breaker = CircuitBreaker(threshold=3, cooldown=6*3600,
+                                                 nvm_failures=NVM_RECONF_FAILURES,
+                                                 nvm_open_until=NVM_RECONF_OPEN_UNTIL)
+            self._status_steps = {
+                STATUS_CHECK          : self._status_check,
+                STATUS_TRACE_START    : self._status_trace_start,
+                STATUS_SYNC           : self._status_sync,
+                STATUS_TRACE_STOP     : self._status_trace_stop,
+                STATUS_SYNC_STATUS    : self._status_sync_status,
+                STATUS_RECONF_HUB     : self._status_reconf_hub,
+                STATUS_RECONF_VERSION : self._status_reconf_version,
+                STATUS_RECONF_WIFI    : self._status_reconf_wifi,
+                STATUS_RECONF_RESTART : self._status_reconf_restart,
+                STATUS_RESTART_WAIT   : self._status_restart_wait,
+                }
+
+            self.boot_metrics = {"fast_start" : False}
+            self._time_sync_pending = False
+
+            if fast_start and self.config_unchanged() and self.rtc_valid():
+                # e.g. a warm reboot after an OTA update. Trust the card config
+                # and the RTC, confirm both in the background via service()
+                self.log.info("Config unchanged since last boot, skipping checks")
+                self.boot_metrics["fast_start"] = True
+                self.request_status(nosync_timeout=100)
+                self._time_sync_pending = True
+            else:
+                self.check_config()
+                self.wait_for_time()
+                self.sync_time()
 
-            self.check_config()
-            self.wait_for_time()
-            self.sync_time()
+            self.boot_metrics["init"] = time.monotonic() - _BOOT_TIME
+            self.log.info(f"Notecard Manager ready {self.boot_metrics['init']:.1f}s after boot")
 
             if watchdog:
                 # start a watchdog timer
@@ -104,60 +253,215 @@ class Notecard_manager():
             self.reconfigure()
         else:
             self.log.info('Config OK')
+            self.store_config_hash()
 
+    def config_unchanged(self):
+        # True if the current config matches the last one verified or applied
+        return nvm_read(NVM_CONFIG_HASH) == config_hash()
 
-    def check_status(self, nosync_timeout=None, nosync_warning=120):
-        try:
-            cstatus = card.status(self.ncard)
-            self.log.debug(f"card.status={cstatus}")
-            if "storage" in cstatus:
-                percentage = cstatus["storage"]
-                if percentage > 50:
-                    self.log.info(f"notecard storage at {percentage}%")
-            if "connected" in cstatus:
-                self.connected = True
-                return
-
-            req = {"req":"card.trace"}
-            req["start"] = True
-            self.ncard.Transaction(req)
+    def store_config_hash(self):
+        nvm_write(NVM_CONFIG_HASH, config_hash())
 
-            # Sync with 'allow' to avoid penalty boxes
-            req = {"req": "hub.sync"}
-            req['allow'] = True
-            self.ncard.Transaction(req)
+    def rtc_valid(self):
+        # The RTC keeps time through a warm reboot, but not a power cycle
+        return self.rtc.datetime.tm_year >= 2022
 
-            req = {"req":"card.trace"}
-            req["stop"] = True
-            debug_trace = self.ncard.Transaction(req)
 
-            self.connected = False
-            t_since_sync = nosync_timeout
-            self.last_sync = 0
+    def check_status(self, nosync_timeout=None, nosync_warning=120):
+        """
+        Blocking version of the status state machine, runs the whole sequence.
+        Prefer request_status() + service() in the main loop.
+        """
+        self.request_status(nosync_timeout, nosync_warning)
+        while self.status_state != STATUS_IDLE:
+            if self.status_state == STATUS_RESTART_WAIT or time.monotonic() < self._error_until:
+                time.sleep(0.1)
+            self.service()
+        if time.monotonic() >= self._error_until:
+            self.ship_logs(flush=True)
+
+    def request_status(self, nosync_timeout=None, nosync_warning=120):
+        """
+        Starts a status check (and sync attempt, if not connected), which is
+        advanced one Notecard transaction at a time by service().
+        Ignored if a check is already in progress.
+        """
+        if self.status_state != STATUS_IDLE:
+            return False
+        self._nosync_timeout = nosync_timeout
+        self._nosync_warning = nosync_warning
+        self.status_state = STATUS_CHECK
+        return True
+
+    def service(self):
+        """
+        Call every main loop iteration. Advances the status state machine by
+        at most one Notecard transaction, and never sleeps. After an I2C error,
+        does nothing for error_backoff seconds.
+        Returns True while there is work in progress.
+        """
+        if time.monotonic() < self._error_until:
+            return self.status_state != STATUS_IDLE
+        return self._without_sleeping(self._service)
+
+    def _without_sleeping(self, func, *args):
+        # For main loop calls, handle_exception() backs off instead of sleeping
+        nested = self._nonblocking
+        self._nonblocking = True
+        try:
+            return func(*args)
+        finally:
+            self._nonblocking = nested
+
+    def _service(self):
+        if self.status_state == STATUS_IDLE:
+            if self._urgent_logs:
+                self.ship_logs(urgent=True)
+            elif self._time_sync_pending:
+                # Confirm the RTC time after a fast start
+                self._time_sync_pending = False
+                self.sync_time()
+            elif self.journal and self.journal.pending_replay and self.connected:
+                self.replay_journal()
+            else:
+                self.ship_logs()
+            return False
 
-            rsp = hub.syncStatus(self.ncard)
-            self.log.debug(f"hub.syncStatus = {rsp}")
-            self.display(str(rsp))
-            time.sleep(2)
-            if 'completed' in rsp:
-                t_since_sync = rsp['completed']
-            if 'requested' in rsp:
-                t_since_sync = rsp['requested']
-            if 'time' in rsp:
-                self.last_sync = rsp['time']
-
-            if nosync_warning:
-                if t_since_sync >= nosync_warning:
-                    self.log.debug(f"no sync in {t_since_sync}s")
-            if nosync_timeout:        
-                if t_since_sync >= nosync_timeout:
-                    self.log.critical(f"no sync in {t_since_sync}s, timed out, reconfiguring notecard. Trace = {debug_trace}")
-                    # microcontroller.reset()
-                    self.reconfigure()
-         
+        state = self.status_state
+        start = time.monotonic_ns()
+        try:
+            self.status_state = self._status_steps[state]()
         except Exception as e:
+            self.status_state = STATUS_IDLE
+            self.card_reachable = False
+            if self.journal and len(self.timestamped_note) > 0:
+                # Write ahead, in case the outage ends in a reset
+                self.spill_notes(*self._spill_format)
             self.handle_exception(e)
 
+        # Track the worst case latency added to the main loop, per step
+        elapsed = (time.monotonic_ns() - start) / 1e9
+        if elapsed > self.status_latency.get(state, 0):
+            self.status_latency[state] = elapsed
+            if elapsed > self.service_latency_max:
+                self.service_latency_max = elapsed
+                self.log.debug("new worst case service() latency %.3fs in %s", elapsed, state)
+
+        return self.status_state != STATUS_IDLE
+
+    def _status_check(self):
+        cstatus = card.status(self.ncard)
+        self.log.debug("card.status=%s", cstatus)
+        self.card_reachable = True
+        if "storage" in cstatus:
+            percentage = cstatus["storage"]
+            self.storage = percentage
+            if percentage > 50:
+                self.log.info(f"notecard storage at {percentage}%")
+        if "connected" in cstatus:
+            self.connected = True
+            self.sync_backoff.success()
+            self.reconf_breaker.success()
+            return STATUS_IDLE
+        self.connected = False
+        if not self.sync_backoff.ready():
+            # Skip the sync attempt, but still check how long since the last sync
+            self.log.debug("not connected, next sync attempt in %ss", self.sync_backoff.remaining())
+            return STATUS_SYNC_STATUS
+        return STATUS_TRACE_START
+
+    def _status_trace_start(self):
+        req = {"req":"card.trace"}
+        req["start"] = True
+        self.ncard.Transaction(req)
+        return STATUS_SYNC
+
+    def _status_sync(self):
+        # Sync with 'allow' to avoid penalty boxes
+        req = {"req": "hub.sync"}
+        req['allow'] = True
+        self.ncard.Transaction(req)
+        return STATUS_TRACE_STOP
+
+    def _status_trace_stop(self):
+        req = {"req":"card.trace"}
+        req["stop"] = True
+        self._debug_trace = self.ncard.Transaction(req)
+        self.connected = False
+        # Reset by the next card.status that shows a connection
+        delay = self.sync_backoff.failure()
+        self.log.debug("sync attempt %s, next in %.0fs if not connected", self.sync_backoff.failures, delay)
+        return STATUS_SYNC_STATUS
+
+    def _status_sync_status(self):
+        nosync_timeout = self._nosync_timeout
+        nosync_warning = self._nosync_warning
+        t_since_sync = nosync_timeout
+        self.last_sync = 0
+
+        rsp = hub.syncStatus(self.ncard)
+        self.log.debug("hub.syncStatus = %s", rsp)
+        self.display("%s", rsp)
+        if 'completed' in rsp:
+            t_since_sync = rsp['completed']
+        if 'requested' in rsp:
+            t_since_sync = rsp['requested']
+        if 'time' in rsp:
+            self.last_sync = rsp['time']
+
+        if t_since_sync is None:
+            return STATUS_IDLE
+
+        if nosync_warning:
+            if t_since_sync >= nosync_warning:
+                self.log.debug("no sync in %ss", t_since_sync)
+        if nosync_timeout:
+            if t_since_sync >= nosync_timeout:
+                if not self.try_reconfigure():
+                    return STATUS_IDLE
+                self.log.critical(f"no sync in {t_since_sync}s, timed out, reconfiguring notecard. Trace = {self._debug_trace}")
+                return STATUS_RECONF_HUB
+        return STATUS_IDLE
+
+    def try_reconfigure(self):
+        # Checks the circuit breaker before a reconfigure / restart.
+        # Counts as a failure until a later card.status shows a connection.
+        breaker = self.reconf_breaker
+        if not breaker.allow():
+            self.log.debug("reconfigure skipped, circuit breaker open for %ss", breaker.open_until - time.time())
+            return False
+        breaker.failure()
+        if breaker.failures >= breaker.threshold:
+            self.log.warning(f"{breaker.failures} reconfigures without connecting, "
+                             f"no more until {breaker.cooldown}s after this one")
+        return True
+
+    def _status_reconf_hub(self):
+        self._reconfigure_hub()
+        return STATUS_RECONF_VERSION
+
+    def _status_reconf_version(self):
+        if self._card_is_wifi():
+            return STATUS_RECONF_WIFI
+        return STATUS_RECONF_RESTART
+
+    def _status_reconf_wifi(self):
+        self._reconfigure_wifi()
+        return STATUS_RECONF_RESTART
+
+    def _status_reconf_restart(self):
+        self._restart()
+        self.store_config_hash()
+        self.log.info('restarting Notecard, waiting 20s')
+        self._restart_until = time.monotonic() + 20
+        return STATUS_RESTART_WAIT
+
+    def _status_restart_wait(self):
+        # No transactions while the card restarts
+        if time.monotonic() < self._restart_until:
+            return STATUS_RESTART_WAIT
+        return STATUS_IDLE
+
     def wait_for_time(self):
         try:
             stamp = time.monotonic()
@@ -175,8 +479,9 @@ class Notecard_manager():
 
                 if time.monotonic() - stamp > 100:
                     stamp = time.monotonic()
-                    self.log.critical("Timeout while waiting for notecard time, reconfiguring notecard")
-                    self.reconfigure()
+                    if self.try_reconfigure():
+                        self.log.critical("Timeout while waiting for notecard time, reconfiguring notecard")
+                        self.reconfigure()
 
                 time.sleep(1)
 
@@ -186,11 +491,12 @@ class Notecard_manager():
     def sync_time(self):
         try:
             rsp = card.time(self.ncard)
-            self.log.debug(f"time {rsp=}")
+            self.log.debug("time rsp=%s", rsp)
             if 'time' in rsp:
                 unixtime = rsp['time']
                 self.rtc.datetime = time.localtime(unixtime)
-                self.log.debug(f'RTC syncronised')
+                self.clock.invalidate()
+                self.log.debug('RTC syncronised')
         except Exception as e:
             self.handle_exception(e)
 
@@ -213,106 +519,451 @@ class Notecard_manager():
             self.handle_exception(e)
 
     def receive_environment(self, typed_env=None):
+        """
+        Fetches environment variables if they've been modified on Notehub.
+        If typed_env is provided, changed values are parsed into it, with types
+        matching its existing values. See env_schema.py
+
+        Returns the set of keys that changed, which is empty (i.e. falsy) if none did.
+        """
         try:
 
             modified = env.modified(self.ncard)
             if modified["time"] > self.env_stamp:
-            
+
                 self.log.debug("Updating Environment Variables")
-                self.environment = {}
-                
+
                 rsp = env.get(self.ncard)
+                previous = self.environment
                 self.environment = rsp["body"]
                 self.env_stamp = modified["time"]
-                self.log.debug(f"environment = {self.environment}")
-
-                if typed_env is not None:
-                    for key, val in self.environment.items():
-                        if key in typed_env.keys():
-                            try:
-                                dtype = type(typed_env[key])
-                                if dtype == list:
-                                    if (val[0] == "[") and (val[-1] == "]"):
-                                        typed_val = eval(val)
-                                    else:
-                                        print(f"Couldn't parse {val}, expected a list")
-                                elif dtype == bool:
-                                    typed_val = (val == 'True')
-                                else:
-                                    typed_val = dtype(val)
-
-                                typed_env[key] = typed_val
-                            except Exception as e:
-                                    self.log.error(f"Could not parse {key} = {val}, {e}")
-                            self.log.debug(f"environment update: {key} = {typed_val}")
-                        elif key[0] != "_":
-                            typed_env[key] = val
-                            self.log.debug(f"environment update: {key} = {val} *unknown type*")
-                return True
+                self.log.debug("environment = %s", self.environment)
+
+                if typed_env is None:
+                    return {key for key, val in self.environment.items() if previous.get(key) != val}
+
+                # Compiled once per typed_env dict
+                if self._env_schema is None or self._env_schema.source is not typed_env:
+                    self._env_schema = EnvSchema(typed_env)
+                return self._env_schema.update(self.environment, typed_env, log=self.log)
             else:
                 # No update
-                return False
+                return set()
         except Exception as e:
             self.handle_exception(e)
-
-    def receive_note(self, notefile="data.qi"):
+            return set()
+
+    def receive_note(self, notefile="data.qi", max_notes=1, time_budget=None):
+        """
+        Fetches up to max_notes queued notes from notefile into a FIFO,
+        read them with pop_inbound_note(). Stops early if time_budget (seconds)
+        is exceeded. inbound_notes[notefile] is also set to the latest body.
+        The FIFO holds inbound_max_queue notes, the oldest are dropped (and
+        counted in inbound_dropped) if they aren't popped.
+
+        Returns the number of notes still waiting on the Notecard, which is
+        also kept in inbound_backlog[notefile].
+        """
+        backlog = 0
         try:
-            changes = file.changes(self.ncard)
+            start = time.monotonic()
+            changes = file.changes(self.ncard, files=[notefile])
             if notefile in changes['info']:
-                if "total" in changes['info'][notefile]:
-                    self.log.debug(f"Receiving {notefile}")
-                    rsp = note.get(self.ncard, file=notefile, delete=True)
-                    if "body" in rsp:
-                        self.inbound_notes[notefile] = rsp["body"]
-                        self.log.debug(f'{notefile} = {rsp["body"]}')
+                backlog = changes['info'][notefile].get("total", 0)
+            backlog = self._drain_notefile(notefile, backlog, max_notes, time_budget, start)
         except Exception as e:
             self.handle_exception(e)
-
-
-    def send_timestamped_note(self, sync=True):
+        self.inbound_backlog[notefile] = backlog
+        return backlog
+
+    def _drain_notefile(self, notefile, backlog, max_notes, time_budget, start):
+        # note.get up to max_notes into the FIFO, returns the remaining backlog
+        queue = self.inbound_queue.setdefault(notefile, [])
+        received = 0
+        while backlog > 0 and received < max_notes:
+            if time_budget is not None and received and time.monotonic() - start > time_budget:
+                break
+            self.log.debug("Receiving %s", notefile)
+            rsp = note.get(self.ncard, file=notefile, delete=True)
+            if "err" in rsp:
+                break
+            backlog -= 1
+            received += 1
+            if "body" in rsp:
+                queue.append(rsp["body"])
+                if len(queue) > self.inbound_max_queue:
+                    queue.pop(0)
+                    self.inbound_dropped += 1
+                self.inbound_notes[notefile] = rsp["body"]
+                self.log.debug('%s = %s', notefile, rsp["body"])
+
+        if backlog:
+            self.log.debug("%s notes waiting in %s", backlog, notefile)
+        return backlog
+
+    def subscribe_note(self, notefile, handler):
+        # handler(body) is called by dispatch() for each note received in notefile
+        self.note_handlers.setdefault(notefile, []).append(handler)
+
+    def subscribe_env(self, key, handler):
+        # handler(key, value) is called by dispatch() when environment variable key
+        # changes. key=None subscribes to changes of any key.
+        self.env_handlers.setdefault(key, []).append(handler)
+
+    def dispatch(self, typed_env=None, max_notes=5, time_budget=0.5):
+        """
+        Polls for inbound notes and environment changes, and calls only the
+        handlers for what changed. Uses one file.changes and one env.modified
+        request, plus note.get / env.get for whatever has changed.
+        Returns the number of handler calls. Never sleeps, and does nothing
+        for error_backoff seconds after an I2C error.
+        """
+        if time.monotonic() < self._error_until:
+            return 0
+        return self._without_sleeping(self._dispatch, typed_env, max_notes, time_budget)
+
+    def _dispatch(self, typed_env, max_notes, time_budget):
+        calls = 0
+        start = time.monotonic()
+
+        if self.note_handlers:
+            try:
+                changes = file.changes(self.ncard, files=list(self.note_handlers))
+                info = changes.get('info', {})
+                for notefile in self.note_handlers:
+                    backlog = 0
+                    if notefile in info:
+                        backlog = info[notefile].get("total", 0)
+                    if backlog:
+                        backlog = self._drain_notefile(notefile, backlog, max_notes, time_budget, start)
+                    self.inbound_backlog[notefile] = backlog
+            except Exception as e:
+                self.handle_exception(e)
+
+            for notefile, handlers in self.note_handlers.items():
+                body = self.pop_inbound_note(notefile)
+                while body is not None:
+                    for handler in handlers:
+                        calls += self._call_handler(handler, body)
+                    body = self.pop_inbound_note(notefile)
+
+        if self.env_handlers:
+            changed = self.receive_environment(typed_env)
+            values = self.environment if typed_env is None else typed_env
+            for key in changed:
+                for handler in self.env_handlers.get(key, ()):
+                    calls += self._call_handler(handler, key, values.get(key))
+                for handler in self.env_handlers.get(None, ()):
+                    calls += self._call_handler(handler, key, values.get(key))
+        return calls
+
+    def _call_handler(self, handler, *args):
+        # A failing handler shouldn't stop the others being called
+        try:
+            handler(*args)
+        except Exception as e:
+            self.log.error(f"Error in handler {handler}: {e}")
+        return 1
+
+    def pop_inbound_note(self, notefile="data.qi"):
+        # Returns the oldest received body from notefile, or None
+        queue = self.inbound_queue.get(notefile)
+        if queue:
+            return queue.pop(0)
+        return None
+
+    def send_timestamped_note(self, sync=True, compact=False, scales=None):
+        """
+        compact=True sends the columnar, delta-encoded form from note_encoding.py,
+        with floats as fixed-point integers. scales can override the default
+        scale factor (100) per channel, e.g. {'temp' : 1000}
+
+        If templates are enabled, they take precedence and compact is ignored.
+        """
+        self._spill_format = (compact, scales)
+        if self.compressor:
+            # Include the points held back by swinging door filters
+            self.compressor.flush()
         try:
+            if self.note_templates:
+                self.send_templated_notes(sync=sync)
+                return
+
             if len(self.timestamped_note) > 0:
-                rsp = note.add(self.ncard, file="data.qo", body=self.timestamped_note, sync=sync)
+                if compact:
+                    body = self.timestamped_note.columnar(scales=scales)
+                else:
+                    body = self.timestamped_note.as_dict()
+                rsp = note.add(self.ncard, file="data.qo", body=body, sync=sync)
                 if "err" in rsp:
-                    self.log.warning(f'error sending note {self.timestamped_note}, {rsp["err"]=}')
+                    self.log.warning(f'error sending note {body}, {rsp["err"]=}')
+                else:
+                    self.log.debug('sent note %s, buffer stats %s', body, self.timestamped_note.stats())
+                    self.timestamped_note.clear()
+        except Exception as e:
+            self.handle_exception(e)
+        finally:
+            if self.journal and len(self.timestamped_note) > 0:
+                # The send failed, so move the samples to flash
+                self.spill_notes(compact, scales)
+
+    def send_if_due(self, compact=False, scales=None):
+        """
+        Sends the timestamped note and log when the sync policy says they are due,
+        and requests a sync only when the policy allows. Call regularly, e.g.
+        after each add_to_timestamped_note(), instead of sending on a fixed timer.
+        Returns True if anything was sent. Never sleeps, and does nothing for
+        error_backoff seconds after an I2C error.
+        """
+        if time.monotonic() < self._error_until:
+            return False
+        sent = self._without_sleeping(self._send_if_due, compact, scales)
+        if time.monotonic() >= self._error_until:
+            self._without_sleeping(self.ship_logs)
+        return sent
+
+    def _send_if_due(self, compact, scales):
+        policy = self.sync_policy
+        now = time.monotonic()
+        # Log lines are roughly 64 bytes each once serialised
+        pending = self.timestamped_note.bytes_used + 64 * len(self.timestamped_log)
+        forced = policy.sync_forced(self.storage, now)
+        sync = forced or policy.sync_due(self.storage, self.connected, now)
+
+        if policy.flush_due(pending, self.storage, now):
+            # Only the last note.add carries the sync
+            log_pending = len(self.timestamped_log) > 0
+            self.send_timestamped_note(sync=(sync and not log_pending), compact=compact, scales=scales)
+            if log_pending:
+                self.send_timestamped_log(sync=sync)
+            policy.flushed(now)
+        elif forced:
+            self.log.info(f"notecard storage at {self.storage}%, syncing")
+            try:
+                hub.sync(self.ncard)
+            except Exception as e:
+                self.handle_exception(e)
+        else:
+            return False
+
+        if sync:
+            policy.synced(forced, now)
+        return True
+
+    def spill_notes(self, compact=False, scales=None):
+        if self.compressor:
+            self.compressor.flush()
+        if self.note_templates:
+            # A templated notefile only accepts records, one per sample with its _time
+            floats = float_channels(sample for ts, sample in self.timestamped_note.entries())
+            bodies = [make_record(sample, ts, floats) for ts, sample in self.timestamped_note.entries()]
+            written = self.journal.write_many("data.qo", bodies)
+        else:
+            if compact:
+                body = self.timestamped_note.columnar(scales=scales)
+            else:
+                body = self.timestamped_note.as_dict()
+            written = self.journal.write("data.qo", body)
+        if written:
+            self.log.info(f'spilled {len(self.timestamped_note)} samples to journal')
+            self.timestamped_note.clear()
+
+    def replay_journal(self):
+        # Sends the oldest journaled note, one per call so it can run from service()
+        try:
+            record = self.journal.peek()
+            if record is None:
+                self.log.info('journal replay complete')
+                return
+            notefile, body = record
+            if self.note_templates and notefile in self.note_templates.files and "_time" in body:
+                # A templated record, the template may have changed since it was written
+                sample = {key : val for key, val in body.items() if key != "_time"}
+                if not self._ensure_template(notefile, template_signature(sample)):
+                    body = {body["_time"] : sample}
+            rsp = note.add(self.ncard, file=notefile, body=body, sync=False)
+            if "err" in rsp:
+                # Don't let one bad note block the rest
+                self.log.warning(f'discarding journaled note for {notefile}, {rsp["err"]=}')
+            self.journal.advance()
+        except Exception as e:
+            self.handle_exception(e)
+
+    def send_templated_notes(self, notefile="data.qo", sync=True):
+        # One templated record per sample, each carrying its own _time.
+        # The notefile is re-templated at the start of each run of samples with
+        # the same channels, ensure() is a no-op within a run. Samples that can't
+        # be templated are sent untemplated. Only the last note.add requests a sync.
+        sent = 0
+        try:
+            if len(self.timestamped_note) == 0:
+                return
+            floats = float_channels(sample for ts, sample in self.timestamped_note.entries())
+            failed = None # signature of a run being sent untemplated
+            remaining = len(self.timestamped_note)
+            for ts, sample in self.timestamped_note.entries():
+                remaining -= 1
+                signature = template_signature(sample, floats)
+                if signature != failed and self._ensure_template(notefile, signature):
+                    body = make_record(sample, ts, floats)
                 else:
-                    self.log.debug(f'sent note {self.timestamped_note}')
-                    self.timestamped_note = {}
+                    failed = signature
+                    body = {ts : sample}
+                rsp = note.add(self.ncard, file=notefile, body=body, sync=(sync and remaining == 0))
+                if "err" in rsp:
+                    self.log.warning(f'error sending templated note {body}, {rsp["err"]=}')
+                    break
+                sent += 1
+            self.log.debug('sent %s templated notes to %s', sent, notefile)
         except Exception as e:
             self.handle_exception(e)
+        finally:
+            self.timestamped_note.discard_oldest(sent)
+
+    def _ensure_template(self, notefile, signature):
+        # Returns True if notefile has the template for signature. Otherwise
+        # removes its template, so the caller can send untemplated notes.
+        try:
+            if self.note_templates.ensure(self.ncard, notefile, signature=signature):
+                return True
+            self.log.warning(f'could not register template for {notefile}, sending untemplated')
+        except TypeError as e:
+            self.log.warning(f'{e}, sending {notefile} untemplated')
+        self.note_templates.remove(self.ncard, notefile)
+        return False
 
     def send_timestamped_log(self, sync=True):
+        body = None
         try:
             if len(self.timestamped_log) > 0:
-                rsp = note.add(self.ncard, file="log.qo", body=self.timestamped_log, sync=sync)
+                body = self.timestamped_log.as_body()
+                rsp = note.add(self.ncard, file="log.qo", body=body, sync=sync)
                 if "err" in rsp:
-                    self.log.warning(f'error sending log {self.timestamped_log}, {rsp["err"]=}')
+                    # Not including the body, as this warning is itself added to the log
+                    self.log.warning(f'error sending log, {rsp["err"]=}')
                 else:
-                    self.log.debug(f'sent log {self.timestamped_log}')
-                    self.timestamped_log = {}
+                    self.log.debug('sent log %s', body)
+                    self.timestamped_log.clear()
+                    body = None
+            if body is None:
+                # The card is responding, so also ship any queued WARNING+ records
+                self.ship_logs()
         except Exception as e:
             self.handle_exception(e)
+        finally:
+            if self.journal and len(self.timestamped_log) > 0 and body is not None:
+                # The send failed, so move the log to flash
+                if self.journal.write("log.qo", body):
+                    self.timestamped_log.clear()
+
+    def enable_aggregation(self, window=60, stats=None, default_stats=("mean",), capacity=360):
+        """
+        From now on, add_to_timestamped_note() folds each sample into per-channel
+        statistics, and queues one summary per window instead. Call it as often
+        as samples are captured, e.g. every second with window=60.
+
+        stats chooses the statistics per channel, e.g. {'temp' : ("mean", "std")},
+        otherwise default_stats is used. See aggregator.py
+
+        Replaces compression, if enabled.
+        """
+        self.aggregator = Aggregator(window=window, stats=stats, default_stats=default_stats,
+                                     capacity=capacity)
+        self.aggregator.output.on_full = self._note_channels_full
+        self.compressor = None
+        if len(self.timestamped_note) > 0:
+            self.log.warning(f'discarding {len(self.timestamped_note)} unaggregated samples')
+        self.timestamped_note = self.aggregator.output.unsent
+        self.log.info(f'aggregating samples over {window}s windows')
+
+    def enable_compression(self, filters, capacity=360):
+        """
+        From now on, add_to_timestamped_note() only queues a channel's value when
+        its filter keeps it, e.g. when it has moved beyond a tolerance, or at least
+        every max_interval. Call it as often as samples are captured.
+
+        filters is {channel : Deadband or SwingingDoor}, other channels are
+        queued every sample. See compression.py
+
+        Replaces aggregation, if enabled. Templates aren't used, as the channels
+        vary from row to row.
+        """
+        self.compressor = Compressor(filters=filters, capacity=capacity)
+        self.aggregator = None
+        if self.note_templates:
+            self.log.warning('note templates disabled, rows vary with compression')
+            self.note_templates = None
+        if len(self.timestamped_note) > 0:
+            self.log.warning(f'discarding {len(self.timestamped_note)} uncompressed samples')
+        self.timestamped_note = self.compressor.output.unsent
+        self.log.info(f'compressing {len(self.compressor.filters)} channels')
+
+    def _note_channels_full(self, name):
+        self.log.warning(f'too many note channels, {name} will not be sent')
 
     def add_to_timestamped_note(self, datadict):
         try:
-            ts = time.mktime(self.rtc.datetime)
-            self.timestamped_note[ts] = datadict.copy()
+            ts = self.clock.epoch()
+            # Templates are registered when the batch is sent, see send_templated_notes()
+            if self.compressor:
+                self.compressor.add(ts, datadict)
+            elif self.aggregator:
+                # Only queues a row when a window completes, with the summary channels
+                self.aggregator.add(ts, datadict)
+            else:
+                self.timestamped_note.append(ts, datadict)
+            if "first_sample" not in self.boot_metrics:
+                self.boot_metrics["first_sample"] = time.monotonic() - _BOOT_TIME
+                self.log.info(f"boot to first sample {self.boot_metrics['first_sample']:.1f}s")
+            if self.journal and not self.card_reachable and len(self.timestamped_note) >= self.journal_every:
+                self.spill_notes(*self._spill_format)
         except Exception as e:
             self.handle_exception(e)
 
     def add_to_timestamped_log(self, text, ts):
         try:
-            if ts in self.timestamped_log:
-                self.timestamped_log[ts].append(text)
-            else:
-                self.timestamped_log[ts] = [text]
+            self.timestamped_log.add(text, ts)
         except Exception as e:
             self.handle_exception(e)
 
     def send_note(self, datadict, file="data.qo", sync=True):
         try:
+            if self.note_templates and file in self.note_templates.files:
+                self._ensure_template(file, template_signature(datadict))
+            if not isinstance(datadict, dict):
+                datadict = datadict.copy() # e.g. mcu.data, a SampleStore
             note.add(self.ncard, file=file, body=datadict, sync=sync)
-            self.log.debug(f'sending note {datadict}')
+            self.log.debug('sending note %s', datadict)
+        except Exception as e:
+            self.handle_exception(e)
+
+    def health(self):
+        # Snapshot of link statistics and queue state, e.g. for a periodic health note
+        return {
+            "link"        : self.link_stats.summary(),
+            "buffer"      : self.timestamped_note.stats(),
+            "logs"        : self.log_shipper.stats(),
+            "journal"     : self.journal.stats() if self.journal else None,
+            "aggregation" : self.aggregator.stats() if self.aggregator else None,
+            "compression" : self.compressor.stats() if self.compressor else None,
+            "boot"        : self.boot_metrics,
+            "latency_max" : round(self.service_latency_max, 3),
+            "storage"     : self.storage,
+            "sync"        : self.sync_policy.stats(),
+            "backoff"     : {"failures" : self.sync_backoff.failures,
+                             "retry_in" : self.sync_backoff.remaining(),
+                             "breaker"  : self.reconf_breaker.state()},
+            }
+
+    def send_health_note(self, file="health.qo", sync=False, reset=True):
+        # Intended to be called infrequently, e.g. alongside send_timestamped_note()
+        try:
+            body = self.health()
+            rsp = note.add(self.ncard, file=file, body=body, sync=sync)
+            if "err" in rsp:
+                self.log.warning(f'error sending health note, {rsp["err"]=}')
+            elif reset:
+                self.link_stats.reset()
         except Exception as e:
             self.handle_exception(e)
 
@@ -321,16 +972,40 @@ class Notecard_manager():
         # connect at the top level with e.g.
         # mcu.loghandler.aux_log_function = ncm.log_function
 
-        t = self.rtc.datetime
-        ts = f'{t.tm_year}-{t.tm_mon:02}-{t.tm_mday:02} {t.tm_hour:02}:{t.tm_min:02}:{t.tm_sec:02}'
-        text = f'{record.name} {record.levelname} {record.msg}'
+        ts = self.clock.timestamp()
+        text = format_record(record)
 
         if record.levelno >= logging.WARNING:
-            self.send_note({ts: text}, file="log.qo")
+            self.log_shipper.add(ts, text)
+            if record.levelno >= logging.CRITICAL:
+                # Bypass the batching on the next idle service(), not from
+                # inside a Notecard transaction or just after a bus error
+                self._urgent_logs = True
 
         if record.levelno >= logging.INFO:
             self.add_to_timestamped_log(text, ts)
 
+    def ship_logs(self, urgent=False, flush=False):
+        # Sends queued WARNING+ records as one log.qo note, if the rate limits allow.
+        # Called from service(), check_status(), send_if_due() and send_timestamped_log().
+        # flush doesn't wait for more records to coalesce, see LogShipper.ready()
+        if urgent:
+            self._urgent_logs = False
+        if self._shipping_logs or not self.log_shipper.ready(urgent, flush):
+            return
+        # Guards against recursion, as errors here are themselves logged
+        self._shipping_logs = True
+        body = self.log_shipper.take()
+        try:
+            rsp = note.add(self.ncard, file="log.qo", body=body, sync=urgent)
+            if "err" in rsp:
+                self.log_shipper.requeue(body)
+        except Exception as e:
+            self.log_shipper.requeue(body)
+            self.handle_exception(e)
+        finally:
+            self._shipping_logs = False
+
     def reconfigure(self):
         try:
             # req = {"req": "card.restore"}
@@ -338,41 +1013,61 @@ class Notecard_manager():
             # req["connected"] = False
             # self.ncard.Transaction(req)
 
-            hub.set(self.ncard, 
-                product=notecard_config['productUID'],
-                mode=notecard_config['mode'],
-                sync=notecard_config['sync'],
-                outbound=notecard_config['outbound'],
-                inbound=notecard_config['inbound'])        
-
+            self._reconfigure_hub()
 
             # If it is a wifi notecard, set up SSID/Password
-            req = {"req": "card.version"}
-            cardversion = self.ncard.Transaction(req)
-            if 'sku' in cardversion:
-                if cardversion['sku'] == "NOTE-WIFI":
-                    req = {"req": "card.wifi"}
-                    req["ssid"] = secrets['ssid']
-                    req["password"] = secrets['password']
-                    rsp = self.ncard.Transaction(req)
-
-            req = {"req": "card.restart"}
-            self.ncard.Transaction(req)
+            if self._card_is_wifi():
+                self._reconfigure_wifi()
+
+            self._restart()
+            self.store_config_hash()
             self.log.info('restarting Notecard, waiting 20s')
             time.sleep(20)
         except Exception as e:
             self.handle_exception(e)
 
-    def display(self, message):
+    # Single transaction steps of reconfigure(), shared with the state machine
+
+    def _reconfigure_hub(self):
+        hub.set(self.ncard,
+            product=notecard_config['productUID'],
+            mode=notecard_config['mode'],
+            sync=notecard_config['sync'],
+            outbound=notecard_config['outbound'],
+            inbound=notecard_config['inbound'])
+
+    def _card_is_wifi(self):
+        req = {"req": "card.version"}
+        cardversion = self.ncard.Transaction(req)
+        if 'sku' in cardversion:
+            if cardversion['sku'] == "NOTE-WIFI":
+                return True
+        return False
+
+    def _reconfigure_wifi(self):
+        req = {"req": "card.wifi"}
+        req["ssid"] = secrets['ssid']
+        req["password"] = secrets['password']
+        self.ncard.Transaction(req)
+
+    def _restart(self):
+        req = {"req": "card.restart"}
+        self.ncard.Transaction(req)
+
+    def display(self, message, *args):
         # Special log command with custom level, to request sending to attached display
-        self.log.log(level=25, msg=message)
+        self.log.log(DISPLAY, message, *args)
 
     def handle_exception(self, e):
         cl = e.__class__
         if cl == OSError:
             self.log.error(traceback.format_exception(None, e, e.__traceback__))
-            self.log.warning("{cl} {e}, Notecard restarting, or i2c bus issue, too many pullups?")
-            time.sleep(1)
+            self.log.warning(f"{cl} {e}, Notecard restarting, or i2c bus issue, too many pullups?")
+            if self._nonblocking:
+                # From service(), back off without blocking the main loop
+                self._error_until = time.monotonic() + self.error_backoff
+            else:
+                time.sleep(1)
         else:
             self.log.error(traceback.format_exception(None, e, e.__traceback__))
             self.log.critical(f"Unhandled Notecard Error, Raising")
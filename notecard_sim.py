@@ -0,0 +1,593 @@
+"""
+Host-side (CPython) simulator for running Notecard_manager and Mcu off-device.
+
+FakeNotecard implements the JSON request/response semantics used by
+Notecard_manager: hub.get/set/sync/syncStatus, card.status/time/wifi/version/
+attn/trace/restart, env.*, file.changes and note.add/get/template.
+Latency and failures can be injected.
+
+install_host_shims() puts stand-ins for the CircuitPython-only modules
+(rtc, microcontroller, board, busio, adafruit_logging, notecard etc.) into
+sys.modules, and makes this directory importable as circuitpy_mcu, so that
+e.g. simpletest_notecard.py style code can run on a PC:
+
+    import notecard_sim
+    sim = notecard_sim.install_host_shims()
+    from circuitpy_mcu.notecard_manager import Notecard_manager
+    ncm = Notecard_manager(i2c=object())  # talks to sim.card
+
+This module is not intended to be copied to the microcontroller.
+"""
+
+import sys
+import os
+import time
+import json
+import random
+import types
+from collections import namedtuple
+
+
+class VirtualClock():
+    """
+    Replaces time.monotonic(), time.monotonic_ns(), time.time() and time.sleep(),
+    so hours of main loop can be simulated quickly. Measure real latency with
+    time.perf_counter() instead.
+    """
+    def __init__(self, start_epoch=1672531200):
+        self.epoch = float(start_epoch)
+        self.mono = 1000.0
+        self._orig = None
+        self._localtime = time.localtime
+        self.slept = 0.0 # total seconds spent in time.sleep()
+
+    def advance(self, seconds):
+        self.epoch += seconds
+        self.mono += seconds
+
+    def monotonic(self):
+        return self.mono
+
+    def monotonic_ns(self):
+        return int(self.mono * 1000000000)
+
+    def time(self):
+        return int(self.epoch)
+
+    def sleep(self, seconds):
+        self.slept += seconds
+        self.advance(seconds)
+
+    def localtime(self, secs=None):
+        return self._localtime(self.epoch if secs is None else secs)
+
+    def install(self):
+        self._orig = (time.monotonic, time.monotonic_ns, time.time, time.sleep, time.localtime)
+        time.monotonic = self.monotonic
+        time.monotonic_ns = self.monotonic_ns
+        time.time = self.time
+        time.sleep = self.sleep
+        time.localtime = self.localtime
+
+    def uninstall(self):
+        if self._orig:
+            time.monotonic, time.monotonic_ns, time.time, time.sleep, time.localtime = self._orig
+            self._orig = None
+
+
+class FakeNotecard():
+    """
+    A Notecard that lives in memory.
+
+    latency:        seconds per transaction, or a callable(req) returning seconds
+    sleep:          if True, really sleep for the latency, otherwise it is only
+                    accumulated in busy_time (useful with a VirtualClock)
+    failure_rate:   probability of any transaction raising OSError
+    """
+    def __init__(self, latency=0.0, sleep=False, failure_rate=0.0, seed=0,
+                 connected=True, sku="NOTE-WIFI", clock=None):
+        self.latency = latency
+        self.sleep = sleep
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        # Looked up on each call, so it follows a VirtualClock installed later
+        self.clock = clock or (lambda: time.time())
+
+        self.connected = connected
+        self.sku = sku
+        self.hub = {}
+        self.wifi = {}
+        self.time_set = connected
+        self.restarting_until = 0
+        self.storage_bytes = 0
+        self.storage_capacity = 1024 * 1024
+        self.last_sync = 0
+        self.sync_requested = 0
+
+        self.env_defaults = {}
+        self.env_notehub = {}
+        self.env_modified = 0
+
+        self.notefiles = {} # notefile : list of {"body" :, "time" :}
+        self.templates = {}
+        self.delivered = [] # outbound notes that reached "Notehub"
+
+        self.requests = [] # every request received, in order
+        self.counts = {}
+        self.transaction_count = 0
+        self.busy_time = 0.0
+        self._failures = [] # [request type or None, remaining count, exception]
+
+    # --- host side controls ---
+
+    def inject_failure(self, req=None, count=1, exc=OSError):
+        # The next count transactions of type req (or any type) raise exc
+        self._failures.append([req, count, exc])
+
+    def set_notehub_env(self, name, text):
+        self.env_notehub[name] = str(text)
+        self.env_modified = self.clock()
+
+    def queue_inbound(self, body, notefile="data.qi"):
+        self.notefiles.setdefault(notefile, []).append({"body" : body, "time" : self.clock()})
+
+    def storage_percent(self):
+        return min(100, int(100 * self.storage_bytes / self.storage_capacity))
+
+    # --- the Notecard interface used by note-python helpers ---
+
+    def Transaction(self, req, *args, **kwargs):
+        name = req.get("req", "")
+        self.requests.append(req)
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.transaction_count += 1
+
+        latency = self.latency(req) if callable(self.latency) else self.latency
+        self.busy_time += latency
+        if self.sleep and latency:
+            time.sleep(latency)
+
+        for failure in self._failures:
+            if failure[0] in (None, name) and failure[1] > 0:
+                failure[1] -= 1
+                if failure[1] == 0:
+                    self._failures.remove(failure)
+                raise failure[2](f"simulated failure in {name}")
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            raise OSError(f"simulated I2C failure in {name}")
+        if self.clock() < self.restarting_until:
+            raise OSError("simulated Notecard restarting")
+
+        handler = getattr(self, "_" + name.replace(".", "_"), None)
+        if handler is None:
+            return {"err" : f"unknown request: {name} {{not-supported}}"}
+        # Round trip through JSON, as the real card would
+        return json.loads(json.dumps(handler(json.loads(json.dumps(req)))))
+
+    # --- request handlers ---
+
+    def _hub_get(self, req):
+        return dict(self.hub)
+
+    def _hub_set(self, req):
+        for key in ("product", "mode", "sync", "inbound", "outbound"):
+            if key in req:
+                self.hub[key] = req[key]
+        return {}
+
+    def _hub_sync(self, req):
+        self.sync_requested = self.clock()
+        if self.connected:
+            self.last_sync = self.clock()
+            self.time_set = True
+            for notefile in list(self.notefiles):
+                if notefile.endswith(".qo"):
+                    for n in self.notefiles.pop(notefile):
+                        self.delivered.append((notefile, n))
+            self.storage_bytes = 0
+        return {}
+
+    def _hub_syncStatus(self, req):
+        now = self.clock()
+        rsp = {}
+        if self.last_sync:
+            rsp["time"] = self.last_sync
+            rsp["completed"] = now - self.last_sync
+            rsp["status"] = "completed {sync-end}"
+        elif self.sync_requested:
+            rsp["requested"] = now - self.sync_requested
+            rsp["status"] = "connecting {sync-begin}"
+        return rsp
+
+    def _card_status(self, req):
+        rsp = {"status" : "{normal}", "storage" : self.storage_percent()}
+        if self.time_set:
+            rsp["time"] = self.clock()
+        if self.connected:
+            rsp["connected"] = True
+        return rsp
+
+    def _card_time(self, req):
+        if not self.time_set:
+            return {"err" : "time is not yet set {no-time}"}
+        return {"time" : self.clock(), "zone" : "UTC,Unknown"}
+
+    def _card_wifi(self, req):
+        if "ssid" in req:
+            self.wifi = {"ssid" : req["ssid"], "password" : req.get("password")}
+        if self.wifi:
+            return {"ssid" : self.wifi["ssid"]}
+        return {}
+
+    def _card_version(self, req):
+        return {"sku" : self.sku, "version" : "notecard-sim"}
+
+    def _card_attn(self, req):
+        return {}
+
+    def _card_trace(self, req):
+        return {}
+
+    def _card_restart(self, req):
+        self.restarting_until = self.clock() + 5
+        return {}
+
+    def _env_default(self, req):
+        name = req.get("name")
+        text = req.get("text")
+        if text in (None, ""):
+            self.env_defaults.pop(name, None)
+        else:
+            self.env_defaults[name] = text
+        self.env_modified = self.clock()
+        return {}
+
+    def _env_set(self, req):
+        return {"err" : "env.set is not simulated, use set_notehub_env()"}
+
+    def _env_get(self, req):
+        body = dict(self.env_defaults)
+        body.update(self.env_notehub)
+        if "name" in req:
+            return {"text" : body.get(req["name"], ""), "time" : self.env_modified}
+        return {"body" : body, "time" : self.env_modified}
+
+    def _env_modified(self, req):
+        return {"time" : self.env_modified}
+
+    def _file_changes(self, req):
+        info = {}
+        total = 0
+        for notefile, notes in self.notefiles.items():
+            if notefile.endswith(".qi") and notes:
+                info[notefile] = {"total" : len(notes)}
+                total += len(notes)
+        return {"changes" : total, "total" : total, "info" : info}
+
+    def _note_add(self, req):
+        notefile = req.get("file", "data.qo")
+        body = req.get("body", {})
+        template = self.templates.get(notefile)
+        if template is not None:
+            for key in body:
+                if key not in template:
+                    return {"err" : f"field {key} not in template {{template-incompatible}}"}
+        size = len(json.dumps(body))
+        self.storage_bytes += size
+        self.notefiles.setdefault(notefile, []).append({"body" : body, "time" : self.clock()})
+        if req.get("sync"):
+            self._hub_sync(req)
+        return {"total" : len(self.notefiles.get(notefile, []))}
+
+    def _note_get(self, req):
+        notefile = req.get("file", "data.qi")
+        notes = self.notefiles.get(notefile)
+        if not notes:
+            return {"err" : f"no notes available in queue {{note-noexist}}"}
+        n = notes.pop(0) if req.get("delete") else notes[0]
+        return dict(n)
+
+    def _note_template(self, req):
+        if "body" not in req:
+            # No body removes the template
+            self.templates.pop(req.get("file", "data.qo"), None)
+            return {}
+        self.templates[req.get("file", "data.qo")] = req["body"]
+        return {"bytes" : len(req["body"])}
+
+
+# --- stand-ins for CircuitPython modules ---
+
+class _Anything():
+    # Accepts any constructor arguments, attribute or method call
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return _Anything()
+
+    def __call__(self, *args, **kwargs):
+        return _Anything()
+
+
+class FakeSerial():
+    # Enough of usb_cdc.Serial for Mcu.read_serial(). Use feed() to type input.
+    def __init__(self):
+        self.rx = bytearray()
+        self.tx = bytearray()
+
+    def feed(self, data):
+        self.rx.extend(data)
+
+    @property
+    def in_waiting(self):
+        return len(self.rx)
+
+    def read(self, n=None):
+        n = len(self.rx) if n is None else min(n, len(self.rx))
+        data = bytes(self.rx[:n])
+        del self.rx[:n]
+        return data
+
+    def readinto(self, buf):
+        n = min(len(buf), len(self.rx))
+        buf[:n] = self.rx[:n]
+        del self.rx[:n]
+        return n
+
+    def write(self, data):
+        self.tx.extend(data)
+        return len(data)
+
+
+class _DigitalInOut():
+    def __init__(self, pin=None):
+        self.value = False
+        self.direction = None
+
+    def switch_to_input(self, pull=None):
+        pass
+
+    def switch_to_output(self, value=False, drive_mode=None):
+        self.value = value
+
+    def deinit(self):
+        pass
+
+
+class _NeoPixel(list):
+    def __init__(self, pin=None, n=1, **kwargs):
+        list.__init__(self, [0] * n)
+        self.brightness = 1.0
+
+
+class _I2C():
+    def __init__(self, *args, devices=(0x0B, 0x17, 0x72), **kwargs):
+        self.devices = list(devices)
+
+    def try_lock(self):
+        return True
+
+    def unlock(self):
+        pass
+
+    def scan(self):
+        return list(self.devices)
+
+    def probe(self, address):
+        return address in self.devices
+
+    def writeto(self, address, buffer, **kwargs):
+        if address not in self.devices:
+            raise OSError(19)
+
+
+class _RTC():
+    # Like the device, setting the RTC moves time.time() when a VirtualClock is installed
+    clock = None
+    _offset = 0
+
+    @property
+    def datetime(self):
+        return time.localtime(time.time() + _RTC._offset)
+
+    @datetime.setter
+    def datetime(self, value):
+        if _RTC.clock is not None:
+            _RTC.clock.epoch = float(time.mktime(value))
+        else:
+            _RTC._offset = time.mktime(value) - time.time()
+
+
+def _logging_module():
+    # Minimal adafruit_logging 5.x API. Like the real library, msg % args is
+    # evaluated before the level check
+    m = types.ModuleType("adafruit_logging")
+    m.NOTSET, m.DEBUG, m.INFO, m.WARNING, m.ERROR, m.CRITICAL = 0, 10, 20, 30, 40, 50
+    names = {0 : "NOTSET", 10 : "DEBUG", 20 : "INFO", 25 : "DISPLAY", 30 : "WARNING", 40 : "ERROR", 50 : "CRITICAL"}
+    LogRecord = namedtuple("LogRecord", ("name", "levelno", "levelname", "msg", "created", "args"))
+    m.LogRecord = LogRecord
+
+    class Handler():
+        def __init__(self, level=0):
+            self.level = level
+
+        def emit(self, record):
+            pass
+
+    class Logger():
+        def __init__(self, name):
+            self.name = name
+            self._level = m.NOTSET
+            self._handlers = []
+
+        def setLevel(self, level):
+            self._level = level
+
+        def getEffectiveLevel(self):
+            return self._level
+
+        def addHandler(self, handler):
+            self._handlers.append(handler)
+
+        def log(self, level, msg, *args):
+            record = LogRecord(self.name, level, names.get(level, str(level)),
+                               msg % args, time.monotonic(), args)
+            if level >= self._level:
+                for h in self._handlers:
+                    h.emit(record)
+
+        def debug(self, msg, *args):
+            self.log(m.DEBUG, msg, *args)
+
+        def info(self, msg, *args):
+            self.log(m.INFO, msg, *args)
+
+        def warning(self, msg, *args):
+            self.log(m.WARNING, msg, *args)
+
+        def error(self, msg, *args):
+            self.log(m.ERROR, msg, *args)
+
+        def critical(self, msg, *args):
+            self.log(m.CRITICAL, msg, *args)
+
+    loggers = {}
+
+    def getLogger(name):
+        if name not in loggers:
+            loggers[name] = Logger(name)
+        return loggers[name]
+
+    m.Handler = Handler
+    m.Logger = Logger
+    m.getLogger = getLogger
+    return m
+
+
+def _notecard_module(sim):
+    # note-python style helpers, each a thin wrapper building a request
+    def helper(name, **fixed):
+        def f(card, **kwargs):
+            req = {"req" : name}
+            req.update(fixed)
+            for key, val in kwargs.items():
+                if val is not None:
+                    req[key] = val
+            return card.Transaction(req)
+        return f
+
+    def env_default(card, name=None, text=None):
+        req = {"req" : "env.default", "name" : name}
+        if text is not None:
+            req["text"] = text
+        return card.Transaction(req)
+
+    def submodule(name, **funcs):
+        sub = types.ModuleType("notecard." + name)
+        sub.__dict__.update(funcs)
+        sys.modules["notecard." + name] = sub
+        return sub
+
+    m = types.ModuleType("notecard")
+    m.Notecard = FakeNotecard
+    m.OpenI2C = lambda *args, **kwargs: sim.card
+    m.hub = submodule("hub", get=helper("hub.get"), set=helper("hub.set"),
+                      sync=helper("hub.sync"), syncStatus=helper("hub.syncStatus"))
+    m.card = submodule("card", status=helper("card.status"), time=helper("card.time"),
+                       attn=helper("card.attn"), version=helper("card.version"))
+    m.file = submodule("file", changes=helper("file.changes"))
+    m.note = submodule("note", add=helper("note.add"), get=helper("note.get"),
+                       template=helper("note.template"))
+    m.env = submodule("env", default=env_default, get=helper("env.get"),
+                      modified=helper("env.modified"), set=helper("env.set"))
+    return m
+
+
+class HostSim():
+    # Returned by install_host_shims(), holds the simulated devices
+    def __init__(self, card, clock, console, data_port, nvm):
+        self.card = card
+        self.clock = clock
+        self.console = console
+        self.data_port = data_port
+        self.nvm = nvm
+
+
+def install_host_shims(card=None, clock=None):
+    """
+    Installs stand-ins for CircuitPython modules and the notecard library.
+    A VirtualClock is installed if one is provided.
+    """
+    repo = os.path.dirname(os.path.abspath(__file__))
+
+    if clock is not None:
+        clock.install()
+    if card is None:
+        card = FakeNotecard()
+
+    console = FakeSerial()
+    data_port = FakeSerial()
+    nvm = bytearray(8192)
+    sim = HostSim(card, clock, console, data_port, nvm)
+
+    def module(name, **attrs):
+        m = types.ModuleType(name)
+        m.__dict__.update(attrs)
+        sys.modules[name] = m
+        return m
+
+    class _Watchdog():
+        timeout = 0
+        mode = None
+
+        def feed(self):
+            pass
+
+    _RTC.clock = clock
+    module("rtc", RTC=_RTC)
+    module("microcontroller", nvm=nvm, reset=lambda: None, watchdog=_Watchdog(),
+           cpu=types.SimpleNamespace(uid=bytes(range(6)), temperature=25.0))
+    module("watchdog", WatchDogTimeout=type("WatchDogTimeout", (Exception,), {}),
+           WatchDogMode=types.SimpleNamespace(RAISE=1, RESET=2))
+    module("supervisor", runtime=types.SimpleNamespace(usb_connected=True),
+           reload=lambda: None, ticks_ms=lambda: int(time.monotonic() * 1000))
+    module("usb_cdc", console=console, data=data_port)
+    module("board", **{pin : pin for pin in ("SCL", "SDA", "TX", "RX", "NEOPIXEL", "LED",
+                                             "I2C_POWER", "D5", "D6")})
+    module("digitalio", DigitalInOut=_DigitalInOut,
+           Direction=types.SimpleNamespace(INPUT=0, OUTPUT=1))
+    module("busio", I2C=_I2C, UART=_Anything)
+    module("analogio", AnalogIn=_Anything)
+    module("neopixel", NeoPixel=_NeoPixel)
+    module("sparkfun_serlcd", Sparkfun_SerLCD_I2C=_Anything)
+    sys.modules["adafruit_logging"] = _logging_module()
+    sys.modules["notecard"] = _notecard_module(sim)
+
+    # Beware, CPython's standard library also has a secrets module
+    try:
+        import secrets as _secrets
+    except ImportError:
+        _secrets = None
+    if not hasattr(_secrets, "notecard_config"):
+        example = {}
+        with open(os.path.join(repo, "templates", "secrets_example.py")) as f:
+            exec(f.read(), example)
+        module("secrets", secrets=example["secrets"], notecard_config=example["notecard_config"])
+
+    if "circuitpy_mcu" not in sys.modules:
+        package = types.ModuleType("circuitpy_mcu")
+        package.__path__ = [repo]
+        sys.modules["circuitpy_mcu"] = package
+
+    # Configure the card so Notecard_manager.check_config() is satisfied
+    from secrets import secrets, notecard_config
+    card.hub = {
+        "product"  : notecard_config["productUID"],
+        "mode"     : notecard_config["mode"],
+        "sync"     : notecard_config["sync"],
+        "inbound"  : notecard_config["inbound"],
+        "outbound" : notecard_config["outbound"],
+        }
+    card.wifi = {"ssid" : secrets["ssid"], "password" : secrets["password"]}
+    return sim
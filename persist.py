@@ -0,0 +1,47 @@
+"""
+Small values that need to survive a reset, stored in microcontroller.nvm.
+
+Each slot is a marker byte followed by a 32 bit unsigned value. A slot that
+has never been written (or was written by something else) reads as None.
+"""
+
+import struct
+import microcontroller
+
+_MARKER = 0xC7
+_SLOT_SIZE = 5
+
+# Slot offsets used by circuitpy_mcu
+NVM_CONFIG_HASH = 0
+NVM_SYNC_FAILURES = 5
+NVM_SYNC_RETRY_AT = 10
+NVM_RECONF_FAILURES = 15
+NVM_RECONF_OPEN_UNTIL = 20
+
+
+def fnv1a32(text):
+    # Simple, dependency free 32 bit hash. Not cryptographic.
+    h = 0x811C9DC5
+    for b in text.encode():
+        h = ((h ^ b) * 0x01000193) & 0xFFFFFFFF
+    return h
+
+
+def nvm_read(offset):
+    nvm = microcontroller.nvm
+    if nvm is None or len(nvm) < offset + _SLOT_SIZE:
+        return None
+    if nvm[offset] != _MARKER:
+        return None
+    return struct.unpack("<I", nvm[offset + 1:offset + _SLOT_SIZE])[0]
+
+
+def nvm_write(offset, value):
+    nvm = microcontroller.nvm
+    if nvm is None or len(nvm) < offset + _SLOT_SIZE:
+        return False
+    data = bytes([_MARKER]) + struct.pack("<I", value & 0xFFFFFFFF)
+    if nvm[offset:offset + _SLOT_SIZE] != data:
+        # Avoid needless flash writes
+        nvm[offset:offset + _SLOT_SIZE] = data
+    return True
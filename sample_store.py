@@ -0,0 +1,315 @@
+"""
+Multichannel sample store backed by preallocated array('f') rings.
+
+Used as mcu.data, it behaves like the dict it replaces (mcu.data['temp'] = 21.5,
+mcu.data.items(), ...), holding the latest value of each channel. commit()
+then copies the latest values into one ring per channel, alongside a shared
+ring of timestamps, without allocating a dict or float objects per sample.
+
+Channels are registered the first time they are set. Numeric values are stored
+as float32 (about 7 significant digits) and missing values as NaN. A channel
+that has only ever been set to ints is read back from the history as ints,
+once it has been set to a float all its values read back as floats. Likewise
+bools are stored as 0/1 and read back as bools while the channel has only
+been set to bools.
+
+Other values (e.g. strings), and numeric channels beyond max_channels, are
+recorded as a dict per sample instead, so cost a few allocations per commit().
+on_full(name) is called the first time each channel beyond max_channels is set.
+
+store.unsent has the same interface as NoteBuffer (see note_buffer.py) for the
+samples not yet sent, so it can stand in as Notecard_manager.timestamped_note.
+Its columnar() export reads straight from the rings. Unlike NoteBuffer there
+is no byte budget or eviction policy: the oldest unsent samples are
+overwritten once capacity is reached, and counted as dropped.
+"""
+
+from array import array
+
+from circuitpy_mcu.note_encoding import FORMAT, DEFAULT_SCALE
+
+_NAN = float("nan")
+
+
+class SampleStore():
+    def __init__(self, capacity=360, max_channels=16):
+        self.capacity = capacity
+        self.max_channels = max_channels
+
+        self.names = [] # channel names, in registration order
+        self.index = {} # name : column number
+        self.current = [] # latest value per channel
+        self.integer = [] # True while the channel has only been set to ints
+        self.boolean = [] # True while the channel has only been set to bools
+        self.columns = [] # array('f') ring per channel
+        self.times = array("L", [0] * capacity) # epoch seconds, shared by all channels
+        self.extra = {} # non-numeric values
+        self.texts = [None] * capacity # extra, as a dict per sample (None if empty)
+        self.unrecorded = [] # channels beyond max_channels, kept in extra
+        self.on_full = None # function(name)
+
+        self._head = 0 # next ring slot to write
+        self.count = 0 # samples held, up to capacity
+        self.seq = 0 # total samples committed
+
+        self.unsent = SampleWindow(self)
+
+    def register(self, name):
+        # Returns the column number, or None if there are already max_channels
+        if len(self.names) >= self.max_channels:
+            if name not in self.unrecorded:
+                self.unrecorded.append(name)
+                if self.on_full:
+                    self.on_full(name)
+            return None
+        self.index[name] = len(self.names)
+        self.names.append(name)
+        self.current.append(None)
+        self.integer.append(True)
+        self.boolean.append(True)
+        self.columns.append(array("f", [_NAN] * self.capacity))
+        return self.index[name]
+
+    # --- dict-like view of the latest values ---
+
+    def __setitem__(self, name, value):
+        i = self.index.get(name)
+        if not isinstance(value, (int, float)):
+            if i is not None:
+                self.current[i] = None # missing from the array while not a number
+            self.extra[name] = value
+            return
+        if i is None:
+            i = self.register(name)
+            if i is None:
+                self.extra[name] = value
+                return
+        if name in self.extra:
+            del self.extra[name]
+        self.current[i] = value
+        # Never back to int or bool, that would truncate the values already recorded
+        if not isinstance(value, int):
+            self.integer[i] = False
+        if not isinstance(value, bool):
+            self.boolean[i] = False
+
+    def __getitem__(self, name):
+        i = self.index.get(name)
+        if i is None or self.current[i] is None:
+            return self.extra[name]
+        return self.current[i]
+
+    def __delitem__(self, name):
+        # The channel stays registered, but isn't recorded until set again
+        if name in self.extra:
+            del self.extra[name]
+        else:
+            self.current[self.index[name]] = None
+
+    def __contains__(self, name):
+        i = self.index.get(name)
+        return (i is not None and self.current[i] is not None) or name in self.extra
+
+    def __len__(self):
+        return sum(1 for val in self.current if val is not None) + len(self.extra)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [name for name, val in zip(self.names, self.current) if val is not None] + list(self.extra)
+
+    def values(self):
+        return [self[name] for name in self.keys()]
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def update(self, datadict):
+        for name, value in datadict.items():
+            self[name] = value
+
+    def copy(self):
+        # A plain dict, e.g. for json
+        return dict(self.items())
+
+    # --- sample history ---
+
+    def commit(self, ts, replace=False):
+        # Records the latest values of all channels at ts (epoch seconds).
+        # replace=True overwrites the newest sample instead.
+        if replace and self.count:
+            i = (self._head - 1) % self.capacity
+        else:
+            i = self._head
+            self._head = (i + 1) % self.capacity
+            if self.count < self.capacity:
+                self.count += 1
+            self.seq += 1
+        self.times[i] = ts
+        for n, column in enumerate(self.columns):
+            val = self.current[n]
+            column[i] = _NAN if val is None else val
+        self.texts[i] = dict(self.extra) if self.extra else None
+
+    def slot(self, seq):
+        # Ring index for sample number seq, which must still be held
+        return (self._head - (self.seq - seq)) % self.capacity
+
+    def oldest_seq(self):
+        return self.seq - self.count
+
+    def value(self, n, i):
+        # Channel n at ring index i, None if missing
+        val = self.columns[n][i]
+        if val != val:
+            return None
+        if self.boolean[n]:
+            return val != 0
+        if self.integer[n]:
+            return int(val)
+        # Trim float32 noise, e.g. 21.530000686645508 back to 21.53
+        return float(f"{val:.7g}")
+
+    def sample(self, seq):
+        # Sample number seq as (ts, dict), without missing values
+        i = self.slot(seq)
+        values = {}
+        for n in range(len(self.names)):
+            val = self.value(n, i)
+            if val is not None:
+                values[self.names[n]] = val
+        if self.texts[i]:
+            values.update(self.texts[i])
+        return self.times[i], values
+
+
+class SampleWindow():
+    """
+    The samples committed to a SampleStore since the last send, with the
+    same interface as NoteBuffer. Samples overwritten in the ring before being
+    sent are counted as dropped.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.start = 0 # seq of the oldest unsent sample
+        self.dropped = 0
+
+    def _first(self):
+        store = self.store
+        oldest = store.oldest_seq()
+        if self.start < oldest:
+            self.dropped += oldest - self.start
+            self.start = oldest
+        return self.start
+
+    def __len__(self):
+        return self.store.seq - self._first()
+
+    @property
+    def bytes_used(self):
+        # Estimated size of the samples in the {ts: sample} JSON form
+        per_sample = 14 + sum(len(name) + 12 for name in self.store.names)
+        per_sample += sum(len(name) + len(str(val)) + 6 for name, val in self.store.extra.items())
+        return len(self) * per_sample
+
+    def append(self, ts, datadict):
+        store = self.store
+        if datadict is not store:
+            store.update(datadict)
+        # Same timestamp as the newest unsent sample, overwrite it as a dict would
+        replace = len(self) > 0 and store.times[store.slot(store.seq - 1)] == ts
+        store.commit(ts, replace)
+        return True
+
+    def entries(self):
+        # Yields (ts, sample) tuples, oldest first. Builds a dict per sample,
+        # prefer columnar() where possible.
+        for seq in range(self._first(), self.store.seq):
+            yield self.store.sample(seq)
+
+    def as_dict(self):
+        return {ts: sample for ts, sample in self.entries()}
+
+    def columnar(self, scales=None, default_scale=DEFAULT_SCALE):
+        # The note_encoding.py columnar body, read directly from the rings.
+        # Channels with no values in the window are left out.
+        store = self.store
+        first = self._first()
+        if first == store.seq:
+            return {}
+        slots = [store.slot(seq) for seq in range(first, store.seq)]
+        t0 = min(store.times[i] for i in slots)
+
+        columns = {}
+        scale_factors = {}
+        for n, name in enumerate(store.names):
+            column = store.columns[n]
+            if store.integer[n]:
+                values = [store.value(n, i) for i in slots]
+            else:
+                scale = default_scale
+                if scales and name in scales:
+                    scale = scales[name]
+                values = []
+                for i in slots:
+                    val = column[i]
+                    values.append(round(val * scale) if val == val else None)
+            if values.count(None) == len(values):
+                continue
+            columns[name] = values
+            if not store.integer[n]:
+                scale_factors[name] = scale
+
+        # Values kept per sample, e.g. strings
+        extra_names = []
+        for i in slots:
+            for name in store.texts[i] or ():
+                if name not in extra_names:
+                    extra_names.append(name)
+        for name in extra_names:
+            values = [(store.texts[i] or {}).get(name) for i in slots]
+            n = store.index.get(name)
+            if n is not None:
+                # Also a number in some samples, merged unscaled
+                scale_factors.pop(name, None)
+                values = [store.value(n, i) if val is None else val for val, i in zip(values, slots)]
+            elif all(val is None or (isinstance(val, (int, float)) and not isinstance(val, bool)) for val in values):
+                # Numeric channels beyond max_channels, scaled as in note_encoding.py
+                if any(isinstance(val, float) for val in values):
+                    scale = default_scale
+                    if scales and name in scales:
+                        scale = scales[name]
+                    values = [None if val is None else round(val * scale) for val in values]
+                    scale_factors[name] = scale
+            columns[name] = values
+
+        body = {
+            "fmt" : FORMAT,
+            "t0"  : t0,
+            "dt"  : [store.times[i] - t0 for i in slots],
+            "c"   : columns,
+            }
+        if scale_factors:
+            body["s"] = scale_factors
+        return body
+
+    def discard_oldest(self, n):
+        self.start = min(self._first() + n, self.store.seq)
+
+    def clear(self):
+        self.start = self.store.seq
+
+    def stats(self):
+        return {
+            "entries"     : len(self),
+            "max_entries" : self.store.capacity,
+            "bytes"       : self.bytes_used,
+            "channels"    : len(self.store.names),
+            "dropped"     : self.dropped,
+            }
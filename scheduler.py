@@ -0,0 +1,166 @@
+"""
+Cooperative scheduler for periodic and one-shot tasks, run from mcu.service().
+
+Replaces the timer_A / timer_B pattern, e.g.
+
+    mcu.scheduler.every(1, blink)
+    mcu.scheduler.every(60, sample, priority=1)
+    mcu.scheduler.after(10, startup_check)
+
+Periodic tasks are scheduled from their previous due time rather than when
+they actually ran, so they don't drift. If a task falls more than a whole
+interval behind, the missed runs are skipped (and counted), not run back to
+back.
+
+When several tasks are due, the highest priority runs first, then the one that
+has been due longest. A task is counted as missing its deadline if it starts
+more than `deadline` seconds after it was due (by default, its interval).
+The watchdog is fed between tasks, and if time_budget is set, remaining tasks
+wait for the next run() once it's used up.
+
+Times are kept in integer nanoseconds, as float monotonic() loses precision
+after a few days of uptime.
+"""
+
+import time
+
+_NS = 1000000000
+
+
+class Task():
+    def __init__(self, func, interval=None, delay=0, priority=0, deadline=None, name=None):
+        self.func = func
+        self.name = name or getattr(func, "__name__", "task")
+        self.interval_ns = int(interval * _NS) if interval else None
+        self.priority = priority
+        if deadline is None and interval:
+            deadline = interval
+        self.deadline_ns = int(deadline * _NS) if deadline is not None else None
+        self.next_run = time.monotonic_ns() + int(delay * _NS)
+        self.enabled = True
+
+        # Statistics
+        self.runs = 0
+        self.errors = 0
+        self.missed = 0 # started after the deadline
+        self.skipped = 0 # periodic runs skipped after falling a whole interval behind
+        self.run_time_max = 0 # seconds
+        self.run_time_total = 0
+        self.late_max = 0 # seconds between due and starting
+
+    def stats(self):
+        return {
+            "runs"    : self.runs,
+            "errors"  : self.errors,
+            "missed"  : self.missed,
+            "skipped" : self.skipped,
+            "max"     : round(self.run_time_max, 4),
+            "mean"    : round(self.run_time_total / self.runs, 4) if self.runs else 0,
+            "late"    : round(self.late_max, 4),
+            }
+
+
+class Scheduler():
+    def __init__(self, watchdog_feed=None, time_budget=None, log=None):
+        self.tasks = []
+        self.watchdog_feed = watchdog_feed
+        self.time_budget = time_budget # seconds per run(), or None for no limit
+        self.log = log
+
+    def every(self, interval, func, priority=0, deadline=None, delay=0, name=None):
+        # Runs func() every interval seconds, first after delay seconds
+        task = Task(func, interval, delay, priority, deadline, name)
+        self.tasks.append(task)
+        return task
+
+    def after(self, delay, func, priority=0, deadline=None, name=None):
+        # Runs func() once, delay seconds from now
+        task = Task(func, None, delay, priority, deadline, name)
+        self.tasks.append(task)
+        return task
+
+    def cancel(self, task):
+        task.enabled = False
+        if task in self.tasks:
+            self.tasks.remove(task)
+
+    def _next_due(self, now):
+        # Highest priority due task, then the one due longest. No allocation.
+        best = None
+        for task in self.tasks:
+            if not task.enabled or task.next_run > now:
+                continue
+            if (best is None or task.priority > best.priority
+                    or (task.priority == best.priority and task.next_run < best.next_run)):
+                best = task
+        return best
+
+    def run(self):
+        """
+        Runs every task that is due, each at most once. Call from the main loop,
+        e.g. via mcu.service(). Returns the number of tasks run.
+        """
+        start = time.monotonic_ns()
+        count = 0
+        while True:
+            now = time.monotonic_ns()
+            if self.time_budget is not None and count and now - start > self.time_budget * _NS:
+                break
+            task = self._next_due(now)
+            if task is None:
+                break
+
+            late = now - task.next_run
+            if task.deadline_ns is not None and late > task.deadline_ns:
+                task.missed += 1
+            if late / _NS > task.late_max:
+                task.late_max = late / _NS
+
+            if task.interval_ns:
+                task.next_run += task.interval_ns
+                if task.next_run <= now:
+                    behind = (now - task.next_run) // task.interval_ns + 1
+                    task.skipped += behind
+                    task.next_run += behind * task.interval_ns
+            else:
+                self.tasks.remove(task)
+
+            try:
+                task.func()
+            except Exception as e:
+                task.errors += 1
+                if self.log:
+                    self.log.error(f"Error in task {task.name}: {e}")
+
+            elapsed = (time.monotonic_ns() - now) / _NS
+            task.runs += 1
+            task.run_time_total += elapsed
+            if elapsed > task.run_time_max:
+                task.run_time_max = elapsed
+            count += 1
+
+            if self.watchdog_feed:
+                self.watchdog_feed()
+        return count
+
+    def idle_time(self):
+        # Seconds until the next task is due, e.g. to sleep for
+        now = time.monotonic_ns()
+        soonest = None
+        for task in self.tasks:
+            if task.enabled and (soonest is None or task.next_run < soonest):
+                soonest = task.next_run
+        if soonest is None:
+            return None
+        return max(0, soonest - now) / _NS
+
+    async def run_async(self, max_sleep=1):
+        # Alternative to calling run() from the main loop, where asyncio is available
+        import asyncio
+        while True:
+            self.run()
+            idle = self.idle_time()
+            await asyncio.sleep(max_sleep if idle is None else min(idle, max_sleep))
+
+    def stats(self):
+        return {task.name : task.stats() for task in self.tasks}
@@ -0,0 +1,115 @@
+"""
+Line input from a usb_cdc serial port, without per-byte allocations.
+
+LineAssembler reads whatever is waiting into a preallocated chunk buffer and
+copies bytes into a preallocated line buffer, handing each complete line to a
+callback. Several lines can complete in one call, and "\\r", "\\n" and "\\r\\n"
+all end a line. Lines longer than max_line are discarded (and counted) rather
+than growing the buffer.
+
+CommandTable maps the first word of a line to a handler, e.g.
+
+    mcu.serial_commands.add("pump", set_pump, "pump <speed>")
+
+which is called as set_pump("0.5") for the input "pump 0.5".
+"""
+
+_CR = 13
+_LF = 10
+
+
+class LineAssembler():
+    def __init__(self, max_line=256, chunk_size=64):
+        self.line = bytearray(max_line)
+        self.length = 0
+        self._overflow = False
+        self._last = 0 # previous byte, so "\r\n" is one line ending
+        self.chunk = bytearray(chunk_size)
+        self._chunk_view = memoryview(self.chunk)
+
+        # Counters
+        self.lines = 0
+        self.overflows = 0 # lines discarded for exceeding max_line
+        self.decode_errors = 0
+
+    def read(self, serial, on_line, echo=False):
+        """
+        Reads everything waiting on serial, calling on_line(text) for each
+        complete line. echo writes the input back, as typed.
+        Returns the number of lines.
+        """
+        count = 0
+        line = self.line
+        chunk = self.chunk
+        max_line = len(line)
+        while serial.in_waiting:
+            n = serial.readinto(chunk)
+            if not n:
+                break
+            if echo:
+                serial.write(self._chunk_view[:n])
+            for i in range(n):
+                b = chunk[i]
+                if b == _CR or b == _LF:
+                    if b == _LF and self._last == _CR:
+                        # second half of "\r\n"
+                        self._last = b
+                        continue
+                    self._last = b
+                    if self._overflow:
+                        self.overflows += 1
+                    else:
+                        text = self._decode()
+                        if text is not None:
+                            count += 1
+                            self.lines += 1
+                            on_line(text)
+                    self.length = 0
+                    self._overflow = False
+                    continue
+                self._last = b
+                if self.length < max_line:
+                    line[self.length] = b
+                    self.length += 1
+                else:
+                    self._overflow = True
+        return count
+
+    def _decode(self):
+        try:
+            return bytes(memoryview(self.line)[:self.length]).decode("utf-8")
+        except UnicodeError:
+            self.decode_errors += 1
+            return None
+
+    def clear(self):
+        self.length = 0
+        self._overflow = False
+
+
+class CommandTable():
+    def __init__(self):
+        self.commands = {} # name : (handler, help)
+        self.add("help", self.help, "list commands")
+
+    def add(self, name, handler, help=""):
+        # handler(args) is called with the rest of the line after name, stripped
+        self.commands[name] = (handler, help)
+
+    def remove(self, name):
+        self.commands.pop(name, None)
+
+    def dispatch(self, line):
+        # Returns True if the line matched a command
+        line = line.strip()
+        i = line.find(" ")
+        name = line if i < 0 else line[:i]
+        entry = self.commands.get(name)
+        if entry is None:
+            return False
+        entry[0]("" if i < 0 else line[i + 1:].strip())
+        return True
+
+    def help(self, args=""):
+        for name in sorted(self.commands):
+            print(f"{name:<12} {self.commands[name][1]}")
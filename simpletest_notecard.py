@@ -1,6 +1,7 @@
 from circuitpy_mcu.ota_bootloader import reset, enable_watchdog
 from circuitpy_mcu.mcu import Mcu
 from circuitpy_mcu.notecard_manager import Notecard_manager
+# from circuitpy_mcu.compression import SwingingDoor, Deadband
 import random
 
 import time
@@ -27,10 +28,18 @@ def main():
         # '0x77' : 'Temp/Humidity/Pressure BME280' # Built into some ESP32S2 feathers 
     }
 
-    mcu = Mcu(loglevel=LOGLEVEL, i2c_freq=100000)
+    # Expected devices are re-probed every second, see mcu.i2c_registry
+    mcu = Mcu(loglevel=LOGLEVEL, i2c_freq=100000, i2c_lookup=i2c_dict)
     mcu.attach_display_sparkfun_20x4()
 
-    ncm = Notecard_manager(loghandler=mcu.loghandler, i2c=mcu.i2c, watchdog=120, loglevel=LOGLEVEL)
+    # Samples are buffered in mcu.data's arrays until sent, see sample_store.py
+    ncm = Notecard_manager(loghandler=mcu.loghandler, i2c=mcu.i2c, watchdog=120, loglevel=LOGLEVEL,
+                           sample_store=mcu.data)
+    # Alternatively, queue 1 minute summaries rather than samples, see aggregator.py
+    # Then call ncm.add_to_timestamped_note(mcu.data) from capture(), every second
+    # ncm.enable_aggregation(window=60, stats={'temp' : ("mean", "min", "max")})
+    # Or only queue values that have moved beyond a tolerance, see compression.py
+    # ncm.enable_compression({'temp' : SwingingDoor(0.5), 'humidity' : Deadband(1.0)})
     mcu.log.info(f'STARTING {__filename__} {__version__}')
 
     # set defaults for environment variables, (to be overridden by notehub)
@@ -42,80 +51,78 @@ def main():
     # This will also update env with any overrides from notehub
     ncm.set_default_envs(env)
 
-    def parse_environment():
-        for key, val in env.items():
+    # Handlers are called by ncm.dispatch(), only for what has changed
+    def adjust_pump(key, val):
+        # env may also hold Notehub-only variables, only convert the ones used here
+        if key == 'pump1-speed':
+            print(f'Adjusting pump 1 speed to {float(val)}')
 
-            if key == 'pump1-speed':
-                speed = float(val)
-                print(f'Adjusting pump 1 speed to {speed}')
+        if key == 'pump2-speed':
+            print(f'Adjusting pump 2 speed to {float(val)}')
 
-            if key == 'pump2-speed':
-                speed = float(val)
-                print(f'Adjusting pump 2 speed to {speed}')
+    ncm.subscribe_env('pump1-speed', adjust_pump)
+    ncm.subscribe_env('pump2-speed', adjust_pump)
 
-    parse_environment()
+    # Apply the initial values
+    for key, val in env.items():
+        adjust_pump(key, val)
 
-    def parse_inbound_note(notefile="data.qi"):
+    def parse_inbound_note(note, notefile="data.qi"):
+        for key, val in note.items():
+            mcu.log.info(f"parsing {notefile}: {key} = {val}")
 
-        note = ncm.inbound_notes[notefile]
-        if type(note) == dict:
-            for key in note.keys():
-                val = note.pop(key)
-                mcu.log.info(f"parsing {notefile}: {key} = {val}")
+            if key == 'test':
+                mcu.log.info(f"Test success! val = {val}")
 
-                if key == 'test':
-                    mcu.log.info(f"Test success! val = {val}")
+    ncm.subscribe_note('data.qi', parse_inbound_note)
 
-    timer_A=0
-    timer_B=0
-    timer_C=0
+    def capture():
+        mcu.led.value = not mcu.led.value #heartbeat LED
+
+        timestamp = mcu.get_timestamp()
+        mcu.display_text(timestamp)
+
+        # capture data, can be displayed immediately
+        mcu.data['temp'] = round(random.uniform(15, 30), 4)
+        mcu.data['humidity'] = round(random.uniform(45, 70), 4)
+
+    def service_notecard():
+        mcu.log.debug("servicing notecard now %s", mcu.get_timestamp())
+
+        # Checks if connected, storage availablity, etc.
+        # Non-blocking, progressed by ncm.service(), so ncm.connected may lag by a few loops
+        ncm.request_status()
+        if ncm.connected:
+            mcu.pixel[0] = mcu.pixel.MAGENTA
+        else:
+            mcu.pixel[0] = mcu.pixel.RED
+
+        # Accumulate data with timestamps in a note to send infrequently
+        # Intended to minimise Notehub consumption credits
+        ncm.add_to_timestamped_note(mcu.data)
+
+        # Sends the note and log when enough has accumulated, or every 15 minutes.
+        # Syncs are limited to minimise radio time and Notehub consumption credits,
+        # unless the Notecard's storage is getting full. See sync_policy.py
+        ncm.send_if_due()
+
+        # check for any new inbound notes or environment variable updates,
+        # and pass them to the subscribed handlers
+        ncm.dispatch(env)
+
+        # Can also send data without timesamps, current timestamp will be used
+        # ncm.send_note(mcu.data, sync=True)
+
+    # Run from mcu.service(), which also feeds the watchdog between tasks
+    # mcu.scheduler.stats() shows run times and missed deadlines
+    mcu.scheduler.every(1, capture, priority=1)
+    mcu.scheduler.every(1 * MINUTES, service_notecard)
 
     while True:
         mcu.service()
-        if time.monotonic() - timer_A > 1:
-            timer_A = time.monotonic()
-            mcu.led.value = not mcu.led.value #heartbeat LED
-
-            timestamp = mcu.get_timestamp()
-            mcu.display_text(timestamp)
-
-            # capture data, can be displayed immediately
-            mcu.data['temp'] = round(random.uniform(15, 30), 4)
-            mcu.data['humidity'] = round(random.uniform(45, 70), 4)
-
-
-        if time.monotonic() - timer_B > (1 * MINUTES):
-            timer_B = time.monotonic()
-            mcu.log.debug(f"servicing notecard now {timestamp}")
-
-            # Checks if connected, storage availablity, etc.
-            ncm.check_status()
-            if ncm.connected:
-                mcu.pixel[0] = mcu.pixel.MAGENTA
-            else:
-                mcu.pixel[0] = mcu.pixel.RED
-                
-            # Accumulate data with timestamps in a note to send infrequently
-            # Intended to minimise Notehub consumption credits
-            ncm.add_to_timestamped_note(mcu.data)
-
-            # check for any new inbound notes to parse
-            ncm.receive_note()
-            parse_inbound_note()
-
-            # check for any environment variable updates to parse
-            if ncm.receive_environment(env):
-                parse_environment()
-
-        if time.monotonic() - timer_C > (15 * MINUTES):
-            timer_C = time.monotonic()
-
-            # Send note infrequently (e.g. 15 mins) to minimise consumption credit usage
-            ncm.send_timestamped_note(sync=True)
-            ncm.send_timestamped_log(sync=True)
-
-            # Can also send data without timesamps, current timestamp will be used
-            # ncm.send_note(mcu.data, sync=True)
+
+        # Advances any status check by at most one Notecard transaction
+        ncm.service()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,97 @@
+"""
+Decides when to flush queued notes to the Notecard, and when to ask it to sync.
+
+Flushing (note.add) is cheap, it only writes to the Notecard's flash.
+Syncing (hub.sync) turns the radio on and uses Notehub consumption credits,
+so syncs are limited by a token bucket of `sync_budget` per day.
+
+- Flush when the pending notes reach `flush_bytes`, or `max_interval` seconds
+  after the last flush. Hold them back (in RAM, or the journal) while the
+  card's storage is above `storage_full` %.
+- Sync along with a flush if connected, at most every `sync_interval` seconds
+  and within the budget. When not connected, e.g. in periodic mode, leave it to
+  the Notecard's own outbound interval.
+- Force a sync, ignoring the budget and connection state, when the card's
+  storage is above `storage_high` %. At most every `min_interval` seconds.
+"""
+
+import time
+
+
+class SyncPolicy():
+    def __init__(self, max_interval=15*60, flush_bytes=8192, sync_interval=15*60, sync_budget=96,
+                 storage_high=75, storage_full=90, min_interval=60):
+        self.max_interval = max_interval
+        self.flush_bytes = flush_bytes
+        self.sync_interval = sync_interval
+        self.sync_budget = sync_budget
+        self.storage_high = storage_high
+        self.storage_full = storage_full
+        self.min_interval = min_interval
+
+        now = time.monotonic()
+        self.last_flush = now
+        self.last_sync = now - sync_interval
+        self._tokens = 1
+        self._refilled = now
+
+        # Counters
+        self.flushes = 0
+        self.syncs = 0
+        self.forced_syncs = 0 # syncs due to card storage
+        self.held = 0 # flushes held back because card storage was full
+
+    def _refill(self, now):
+        self._tokens = min(self.sync_budget, self._tokens + (now - self._refilled) * self.sync_budget / 86400)
+        self._refilled = now
+
+    def flush_due(self, pending_bytes, storage, now=None):
+        if now is None:
+            now = time.monotonic()
+        if pending_bytes <= 0:
+            return False
+        if pending_bytes < self.flush_bytes and now - self.last_flush < self.max_interval:
+            return False
+        if storage >= self.storage_full:
+            self.held += 1
+            return False
+        return True
+
+    def sync_forced(self, storage, now=None):
+        # True if card storage is high enough to sync regardless of budget
+        if now is None:
+            now = time.monotonic()
+        return storage >= self.storage_high and now - self.last_sync >= self.min_interval
+
+    def sync_due(self, storage, connected, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self.sync_forced(storage, now):
+            return True
+        if not connected:
+            return False
+        self._refill(now)
+        return self._tokens >= 1 and now - self.last_sync >= self.sync_interval
+
+    def flushed(self, now=None):
+        self.last_flush = time.monotonic() if now is None else now
+        self.flushes += 1
+
+    def synced(self, forced=False, now=None):
+        if now is None:
+            now = time.monotonic()
+        self._refill(now)
+        self._tokens = max(0, self._tokens - 1)
+        self.last_sync = now
+        self.syncs += 1
+        if forced:
+            self.forced_syncs += 1
+
+    def stats(self):
+        return {
+            "flushes" : self.flushes,
+            "syncs"   : self.syncs,
+            "forced"  : self.forced_syncs,
+            "held"    : self.held,
+            "tokens"  : round(self._tokens, 1),
+            }
@@ -0,0 +1,178 @@
+"""
+Binary telemetry frames, e.g. streaming mcu.data over usb_cdc.data at a high rate.
+
+The secondary USB serial port must be enabled in boot.py:
+
+    import usb_cdc
+    usb_cdc.enable(console=True, data=True)
+
+Every frame has a 7 byte header, little endian:
+
+    magic   2 bytes  0xA5 0x5A
+    length  u16      payload bytes
+    seq     u16      frame sequence number, wraps at 65536
+    type    u8       FRAME_SCHEMA or FRAME_SAMPLE
+
+FRAME_SCHEMA payload is the channel names, utf-8, comma separated. It is sent
+whenever the channels change, and every schema_every frames so a reader can
+join part way through.
+FRAME_SAMPLE payload is a u32 timestamp (ms, monotonic) then one float32 per
+channel, in schema order. Only numeric channels (including bools, as 0/1) are
+streamed, other values such as strings are left out of the schema.
+
+There is no checksum, USB is reliable. The magic bytes and length let a reader
+resynchronise, and gaps in seq show dropped frames.
+
+TelemetryStream packs frames into one preallocated buffer. FrameParser
+decodes them, and runs on the host too, see telemetry_reader.py
+"""
+
+import struct
+import time
+
+MAGIC = b"\xa5\x5a"
+HEADER = "<2sHHB"
+HEADER_SIZE = 7
+MAX_PAYLOAD = 1024
+FRAME_SCHEMA = 1
+FRAME_SAMPLE = 2
+
+
+def _numeric(val):
+    return isinstance(val, (int, float))
+
+
+class TelemetryStream():
+    def __init__(self, serial, max_channels=16, schema_every=100):
+        self.serial = serial
+        self.max_channels = max_channels
+        self.schema_every = schema_every
+
+        self.buf = bytearray(HEADER_SIZE + 4 + 4 * max_channels)
+        self._view = memoryview(self.buf)
+        self._frame = None # view of buf for the current sample size
+        self.channels = ()
+        self.seq = 0
+        self._since_schema = 0
+
+        # Counters
+        self.frames = 0
+        self.bytes = 0
+        self.dropped = 0 # frames the port didn't accept in full
+
+    def _changed(self, datadict):
+        numeric = 0
+        for val in datadict.values():
+            if _numeric(val):
+                numeric += 1
+        if min(numeric, self.max_channels) != len(self.channels):
+            return True
+        for key in self.channels:
+            if key not in datadict or not _numeric(datadict[key]):
+                return True
+        return False
+
+    def _write(self, frame):
+        written = self.serial.write(frame)
+        if written is not None and written < len(frame):
+            self.dropped += 1
+        self.frames += 1
+        self.bytes += len(frame)
+        self.seq = (self.seq + 1) & 0xFFFF
+
+    def send_schema(self):
+        # Allocates, but only when the channels change or every schema_every frames
+        payload = ",".join(self.channels).encode()
+        frame = struct.pack(HEADER, MAGIC, len(payload), self.seq, FRAME_SCHEMA) + payload
+        self._write(frame)
+        self._since_schema = 0
+
+    def send(self, datadict, ts_ms=None):
+        """
+        Sends one sample frame with the numeric values in datadict.
+        Other values, and channels beyond max_channels, are ignored.
+        """
+        if self._changed(datadict):
+            self.channels = tuple(sorted(key for key, val in datadict.items() if _numeric(val)))[:self.max_channels]
+            self._frame = self._view[:HEADER_SIZE + 4 + 4 * len(self.channels)]
+            self.send_schema()
+        elif self._since_schema >= self.schema_every:
+            self.send_schema()
+
+        if ts_ms is None:
+            ts_ms = time.monotonic_ns() // 1000000
+        buf = self.buf
+        struct.pack_into(HEADER, buf, 0, MAGIC, 4 + 4 * len(self.channels), self.seq, FRAME_SAMPLE)
+        struct.pack_into("<I", buf, HEADER_SIZE, ts_ms & 0xFFFFFFFF)
+        offset = HEADER_SIZE + 4
+        for key in self.channels:
+            struct.pack_into("<f", buf, offset, datadict[key])
+            offset += 4
+        self._write(self._frame)
+        self._since_schema += 1
+
+    def stats(self):
+        return {
+            "frames"  : self.frames,
+            "bytes"   : self.bytes,
+            "dropped" : self.dropped,
+            }
+
+
+class FrameParser():
+    """
+    Decodes a byte stream of frames. feed() returns a list of samples as
+    (seq, ts_ms, {channel : value}), once a schema frame has been seen.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.channels = None
+        self.last_seq = None
+
+        # Counters
+        self.frames = 0
+        self.lost = 0 # frames missing from the sequence
+        self.resyncs = 0 # times bytes were skipped to find the magic
+
+    def feed(self, data):
+        self.buffer.extend(data)
+        samples = []
+        while True:
+            start = self.buffer.find(MAGIC)
+            if start < 0:
+                # keep a possible first magic byte
+                keep = 1 if self.buffer[-1:] == MAGIC[:1] else 0
+                if len(self.buffer) > keep:
+                    self.resyncs += 1
+                    del self.buffer[:len(self.buffer) - keep]
+                break
+            if start > 0:
+                self.resyncs += 1
+                del self.buffer[:start]
+            if len(self.buffer) < HEADER_SIZE:
+                break
+            _, length, seq, ftype = struct.unpack_from(HEADER, self.buffer, 0)
+            if length > MAX_PAYLOAD:
+                # Not a real frame, the magic appeared in other data
+                self.resyncs += 1
+                del self.buffer[:1]
+                continue
+            if len(self.buffer) < HEADER_SIZE + length:
+                break
+            payload = bytes(self.buffer[HEADER_SIZE:HEADER_SIZE + length])
+            del self.buffer[:HEADER_SIZE + length]
+
+            if self.last_seq is not None:
+                self.lost += (seq - self.last_seq - 1) & 0xFFFF
+            self.last_seq = seq
+            self.frames += 1
+
+            if ftype == FRAME_SCHEMA:
+                self.channels = payload.decode().split(",") if payload else []
+            elif ftype == FRAME_SAMPLE and self.channels is not None:
+                n = (length - 4) // 4
+                if n != len(self.channels):
+                    continue
+                values = struct.unpack_from(f"<I{n}f", payload, 0)
+                samples.append((seq, values[0], dict(zip(self.channels, values[1:]))))
+        return samples
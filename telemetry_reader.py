@@ -0,0 +1,49 @@
+"""
+Host-side reader for the binary telemetry stream from Mcu.enable_telemetry()
+
+Requires pyserial, e.g.
+
+    pip install pyserial
+    python telemetry_reader.py /dev/ttyACM1 > samples.csv
+
+The data port is the second serial port the board presents, the first is the REPL console.
+Writes CSV to stdout, and a summary of frames and sequence gaps to stderr.
+"""
+
+import argparse
+import sys
+
+from telemetry import FrameParser
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("port", help="usb_cdc.data serial port, e.g. /dev/ttyACM1 or COM5")
+    parser.add_argument("--count", type=int, default=0, help="stop after this many samples, 0 to run until interrupted")
+    args = parser.parse_args()
+
+    import serial
+    port = serial.Serial(args.port, timeout=0.1)
+    frames = FrameParser()
+    channels = None
+    count = 0
+
+    try:
+        while not args.count or count < args.count:
+            data = port.read(port.in_waiting or 1)
+            for seq, ts_ms, sample in frames.feed(data):
+                if list(sample) != channels:
+                    channels = list(sample)
+                    print(",".join(["seq", "ts_ms"] + channels))
+                print(",".join([str(seq), str(ts_ms)] + [f"{v:.6g}" for v in sample.values()]))
+                count += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        port.close()
+        print(f"{count} samples, {frames.frames} frames, {frames.lost} lost, {frames.resyncs} resyncs",
+              file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -147,7 +147,7 @@ def main():
 
         if time.monotonic() - timer_B > (1 * MINUTES):
             timer_B = time.monotonic()
-            mcu.log.debug(f"servicing notecard now {timestamp}")
+            mcu.log.debug("servicing notecard now %s", timestamp)
 
             ncm.check_status()
 